@@ -18,6 +18,8 @@ from toshi_hazard_post.hazard_aggregation.aggregate_rlzs import (
     get_branch_weights,
     build_branches,
     calculate_aggs,
+    calculate_hazard,
+    get_logic_tree_index,
 )
 
 INV_TIME = 1.0
@@ -28,7 +30,8 @@ def convert_values(values_dict):
     for key, vd1 in values_dict.items():
         for loc, vd2 in vd1.items():
             for imt, vals in vd2.items():
-                values.set_values(value=vals, key=key, loc=loc, imt=imt)
+                hazard_id, rlz = key.split(':')
+                values.set_values(value=vals, hazard_id=hazard_id, rlz=rlz, loc=loc, imt=imt)
     return values
 
 
@@ -65,7 +68,8 @@ def generate_values():
             ),
             INV_TIME,
         ),
-        key="hazsol_0:0",
+        hazard_id="hazsol_0",
+        rlz="0",
         loc='WLG',
         imt='PGA',
     )
@@ -76,7 +80,8 @@ def generate_values():
             ),
             INV_TIME,
         ),
-        key="hazsol_0:1",
+        hazard_id="hazsol_0",
+        rlz="1",
         loc='WLG',
         imt='PGA',
     )
@@ -87,7 +92,8 @@ def generate_values():
             ),
             INV_TIME,
         ),
-        key="hazsol_0:2",
+        hazard_id="hazsol_0",
+        rlz="2",
         loc='WLG',
         imt='PGA',
     )
@@ -98,7 +104,8 @@ def generate_values():
             ),
             INV_TIME,
         ),
-        key="hazsol_1:0",
+        hazard_id="hazsol_1",
+        rlz="0",
         loc='WLG',
         imt='PGA',
     )
@@ -109,7 +116,8 @@ def generate_values():
             ),
             INV_TIME,
         ),
-        key="hazsol_1:1",
+        hazard_id="hazsol_1",
+        rlz="1",
         loc='WLG',
         imt='PGA',
     )
@@ -121,7 +129,8 @@ def generate_values():
             ),
             INV_TIME,
         ),
-        key="hazsol_3:0",
+        hazard_id="hazsol_3",
+        rlz="0",
         loc='WLG',
         imt='PGA',
     )
@@ -132,7 +141,8 @@ def generate_values():
             ),
             INV_TIME,
         ),
-        key="hazsol_3:1",
+        hazard_id="hazsol_3",
+        rlz="1",
         loc='WLG',
         imt='PGA',
     )
@@ -202,6 +212,10 @@ class TestBranchFunctions(unittest.TestCase):
         assert branch_probs.shape[1] == end_ind - start_ind
         assert np.allclose(branch_probs, self._branch_probs)
 
+        rlz_index = get_logic_tree_index(self._logic_tree)
+        branch_probs = build_branches(self._logic_tree, values, imt, loc, start_ind, end_ind, rlz_index)
+        assert np.allclose(branch_probs, self._branch_probs)
+
     def test_calculate_aggs(self):
 
         weights = np.array([0.1, 0.1, 0.2, 0.3, 0.1, 0.2])
@@ -211,6 +225,18 @@ class TestBranchFunctions(unittest.TestCase):
 
         assert np.allclose(hazard_agg, expected)
 
+    def test_calculate_hazard(self):
+
+        values = generate_values()
+        weights = get_branch_weights(self._logic_tree)
+        aggs = ['mean', 'std', 'cov', '0.1', '0.6']
+        rlz_index = get_logic_tree_index(self._logic_tree)
+        hazard = calculate_hazard(rlz_index, values, 'WLG', 'PGA', aggs, weights)
+        expected = calculate_aggs(build_branches(self._logic_tree, values, 'PGA', 'WLG', 0, 10), aggs, weights)
+
+        assert hazard.shape == (10, len(aggs))
+        assert np.allclose(hazard, expected)
+
     def test_get_branch_weights(self):
 
         branch_weights = get_branch_weights(self._logic_tree)
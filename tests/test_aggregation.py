@@ -1,12 +1,13 @@
 import unittest
 import json
+import multiprocessing
 from pathlib import Path
 from unittest import mock
 
 import numpy as np
 
 import toshi_hazard_post.hazard_aggregation.aggregation
-from toshi_hazard_post.hazard_aggregation.aggregation import AggTaskArgs
+from toshi_hazard_post.hazard_aggregation.aggregation import TASK_BATCH, AggregationWorkerMP, AggTaskArgs, batch_tasks
 
 # from .test_branch_combinator import convert_gmcm_branches, convert_source_branches
 from .test_aggregate_rlzs import convert_values
@@ -88,3 +89,57 @@ class TestAggregation(unittest.TestCase):
         for ind, expected in kwargs_expected.items():
             kwargs = {k: v for k, v in mock_hazard_agg.mock_calls[int(ind)].kwargs.items() if k in kwds}
             assert kwargs == expected
+
+
+def agg_task(loc):
+    return AggTaskArgs(
+        hazard_model_id='MODEL',
+        grid_loc=loc,
+        locs=[loc],
+        logic_tree='logic_tree',
+        aggs=['mean'],
+        imts=['PGA'],
+        levels=[],
+        vs30=400,
+        deagg=False,
+        poe=None,
+        deagg_imtl=None,
+        save_rlz=False,
+        stride=None,
+        skip_save=True,
+    )
+
+
+class TestBatchTasks(unittest.TestCase):
+    def test_batch_tasks(self):
+        tasks = [agg_task(f'loc_{i}') for i in range(2 * TASK_BATCH + 1)]
+
+        batches = batch_tasks(tasks, 2)
+        assert [len(batch) for batch in batches] == [TASK_BATCH, TASK_BATCH, 1]
+        assert [task for batch in batches for task in batch] == tasks
+
+        # every worker gets a batch when there are few tasks
+        assert [len(batch) for batch in batch_tasks(tasks[:6], 4)] == [2, 2, 2]
+        assert batch_tasks([], 4) == []
+
+
+@mock.patch('toshi_hazard_post.hazard_aggregation.aggregation.process_location_list')
+class TestAggregationWorker(unittest.TestCase):
+    def test_failed_task(self, mock_process):
+        def process(task_args):
+            if task_args.locs == ['missing']:
+                raise KeyError(task_args.locs[0])
+
+        mock_process.side_effect = process
+        task_queue = multiprocessing.JoinableQueue()
+        result_queue = multiprocessing.Queue()
+        task_queue.put([agg_task('loc_0'), agg_task('missing'), agg_task('loc_1')])
+        task_queue.put(None)
+
+        AggregationWorkerMP(task_queue, result_queue).run()
+
+        # the location missing from the store fails alone, the rest of its batch is still processed
+        results = [result_queue.get(timeout=5) for i in range(3)]
+        assert results == ['loc_0', "FAILED ['missing']", 'loc_1']
+        assert mock_process.call_count == 3
+        task_queue.join()
@@ -9,6 +9,9 @@ from toshi_hazard_post.calculators import (
     rate_to_prob,
     weighted_avg_and_std,
     calculate_weighted_quantiles,
+    calculate_weighted_quantiles_2d,
+    sum_rows_by_branch,
+    branch_stats,
 )
 
 
@@ -35,6 +38,36 @@ class TestProbRate(unittest.TestCase):
         assert np.allclose(probs, self._probs)
 
 
+class TestSumRows(unittest.TestCase):
+    def test_sum_rows_by_branch(self):
+
+        table = np.arange(12, dtype=float).reshape(4, 3)
+        rows = np.array([0, 1, 1, 2, 3, 0])
+        offsets = np.array([0, 2, 3, 6])
+        sums = sum_rows_by_branch(table, rows, offsets)
+        expected = np.array([table[0] + table[1], table[1], table[2] + table[3] + table[0]])
+
+        assert sums.shape == expected.shape
+        assert np.allclose(sums, expected)
+
+    def test_branch_stats(self):
+
+        # more columns than one block so that a full and a partial block are summed
+        table = np.arange(4 * 150, dtype=float).reshape(4, 150) ** 1.5
+        rows = np.array([0, 1, 1, 2, 3, 0])
+        offsets = np.array([0, 2, 3, 6])
+        weights = np.array([0.2, 0.5, 0.3])
+        quantiles = np.array([0.1, 0.5, 0.9])
+        mean, std, wq = branch_stats(table, rows, offsets, weights, quantiles)
+
+        sums = sum_rows_by_branch(table, rows, offsets)
+        for col in range(table.shape[1]):
+            mean_expected, std_expected = weighted_avg_and_std(sums[:, col], weights)
+            assert np.isclose(mean[col], mean_expected)
+            assert np.isclose(std[col], std_expected)
+            assert np.allclose(wq[:, col], calculate_weighted_quantiles(sums[:, col], weights, quantiles))
+
+
 class TestMeanStd(unittest.TestCase):
     def setUp(self):
         self._weights_values_file = Path(Path(__file__).parent, 'fixtures/calculators', 'weights_and_values.json')
@@ -70,3 +103,14 @@ class TestQuantiles(unittest.TestCase):
         weighted_quantiles_expeced = [4]
 
         assert np.allclose(weighted_quantiles, weighted_quantiles_expeced)
+
+    def test_calculate_quantiles_2d(self):
+
+        quantiles = [0.1, 0.5, 0.9]
+        values = np.array([self._values, self._values[::-1], self._values**2]).T
+        weighted_quantiles = calculate_weighted_quantiles_2d(values, self._weights, quantiles)
+
+        assert weighted_quantiles.shape == (len(quantiles), values.shape[1])
+        for i in range(values.shape[1]):
+            expected = calculate_weighted_quantiles(values[:, i], self._weights, quantiles)
+            assert np.allclose(weighted_quantiles[:, i], expected)
@@ -0,0 +1,72 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+
+from toshi_hazard_post.data_functions import ValueStore, load_realization_values
+
+
+class TestValueStore(unittest.TestCase):
+    def setUp(self):
+        self._values = ValueStore()
+        for i in range(100):
+            self._values.set_values(
+                value=np.full(10, float(i)), hazard_id=f'hazsol_{i % 4}', rlz=str(i), loc=f'loc_{i % 3}', imt='PGA'
+            )
+
+    def test_values(self):
+
+        assert len(self._values) == 100
+        assert self._values.len_rate == 10
+        assert np.all(self._values.values(hazard_id='hazsol_1', rlz='61', loc='loc_1', imt='PGA') == 61.0)
+
+        rows = self._values.rows([('hazsol_1', '61'), ('hazsol_2', '58')], 'loc_1', 'PGA')
+        assert np.all(self._values.array[rows, 0] == [61.0, 58.0])
+
+        # overwriting an existing key does not add a row
+        self._values.set_values(value=np.zeros(10), hazard_id='hazsol_1', rlz='61', loc='loc_1', imt='PGA')
+        assert len(self._values) == 100
+        assert np.all(self._values.values(hazard_id='hazsol_1', rlz='61', loc='loc_1', imt='PGA') == 0.0)
+
+    def test_metadata(self):
+
+        assert self._values.toshi_hazard_ids == {'hazsol_0', 'hazsol_1', 'hazsol_2', 'hazsol_3'}
+        assert self._values.locs('hazsol_0') == {'loc_0', 'loc_1', 'loc_2'}
+        assert self._values.locs('missing') == set()
+        assert self._values.locs_by_id() == {id: self._values.locs(id) for id in self._values.toshi_hazard_ids}
+
+
+def rlz_curves(locs, vs30s, rlzs, toshi_ids, imts):
+    for toshi_id in toshi_ids:
+        for rlz in rlzs:
+            for loc in locs:
+                values = [SimpleNamespace(imt=imt, vals=[0.1, 0.01]) for imt in imts]
+                yield SimpleNamespace(hazard_solution_id=toshi_id, rlz=rlz, nloc_001=loc, values=values)
+
+
+@mock.patch('toshi_hazard_post.data_functions.toshi_hazard_store.query_v3.get_rlz_curves_v3', side_effect=rlz_curves)
+class TestLoadRealizationValues(unittest.TestCase):
+    def test_grouped_realizations(self, mock_query):
+
+        rlzs = {'hazsol_0': [0, 1], 'hazsol_1': [0, 1], 'hazsol_2': [2]}
+        with self.assertLogs('toshi_hazard_post.data_functions', level='WARNING') as logs:
+            values = load_realization_values(
+                ['hazsol_0', 'hazsol_1', 'hazsol_2', 'hazsol_3'], ['loc_0'], [400], ['PGA'], rlzs
+            )
+
+        # ids that share realizations are queried together, an id missing from rlzs gets every realization
+        assert [call.args[2:4] for call in mock_query.call_args_list] == [
+            ([0, 1], ['hazsol_0', 'hazsol_1']),
+            ([2], ['hazsol_2']),
+            (list(range(21)), ['hazsol_3']),
+        ]
+        assert 'hazsol_3' in logs.output[0]
+        assert len(values) == 2 + 2 + 1 + 21
+        assert values.values(hazard_id='hazsol_2', rlz='2', loc='loc_0', imt='PGA').shape == (2,)
+
+    def test_all_realizations(self, mock_query):
+
+        values = load_realization_values(['hazsol_0', 'hazsol_1'], ['loc_0'], [400], ['PGA'])
+        mock_query.assert_called_once_with(['loc_0'], [400], list(range(21)), ['hazsol_0', 'hazsol_1'], ['PGA'])
+        assert len(values) == 42
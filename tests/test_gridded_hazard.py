@@ -0,0 +1,130 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+from pynamodb.exceptions import PutError
+from toshi_hazard_store import model
+
+from toshi_hazard_post.hazard_grid.gridded_hazard import (
+    calc_gridded_hazard,
+    gridded_hazard_sort_key,
+    process_gridded_hazard,
+    save_gridded_hazard,
+)
+from toshi_hazard_post.hazard_grid.gridded_poe import compute_hazard_at_poe
+
+
+def hazard_curve(loc, levels, values):
+    return SimpleNamespace(nloc_001=loc, values=[SimpleNamespace(lvl=lvl, val=val) for lvl, val in zip(levels, values)])
+
+
+class TestProcessGriddedHazard(unittest.TestCase):
+    def setUp(self):
+        self._location_keys = ['loc_0', 'loc_1', 'loc_2', 'loc_3']
+        levels = np.logspace(-3, 1, 30)
+        poes = np.logspace(-0.5, -6, 30)
+        # each curve has its own levels and one has fewer levels than the others, loc_2 has no curve
+        self._curves = {
+            'loc_0': (levels, poes),
+            'loc_1': (levels * 2.0, poes),
+            'loc_3': (levels[:25], poes[:25] * 0.5),
+        }
+        self._covs = {loc: (levels, np.linspace(0.2, 0.6, len(levels))) for loc, (levels, _) in self._curves.items()}
+
+    def get_hazard_curves(self, location_keys, vs30s, hazard_model_ids, imts, aggs):
+        curves = self._covs if aggs == ['cov'] else self._curves
+        for loc in location_keys:
+            if loc in curves:
+                yield hazard_curve(loc, *curves[loc])
+
+    def test_process_gridded_hazard(self):
+
+        poe_levels = [0.02, 0.1]
+        with mock.patch(
+            'toshi_hazard_post.hazard_grid.gridded_hazard.query_v3.get_hazard_curves',
+            side_effect=self.get_hazard_curves,
+        ):
+            ghazs = list(process_gridded_hazard(self._location_keys, poe_levels, 'GRID', 'MODEL', 400, 'PGA', 'mean'))
+
+        assert [(ghaz.agg, ghaz.poe) for ghaz in ghazs] == [('cov', 0.02), ('cov', 0.1), ('mean', 0.02), ('mean', 0.1)]
+        for ghaz in ghazs:
+            # missing locations are None, in place
+            assert len(ghaz.grid_poes) == len(self._location_keys)
+            assert ghaz.grid_poes[2] is None
+
+        for ghaz in ghazs[2:]:
+            for i, loc in enumerate(self._location_keys):
+                if loc in self._curves:
+                    expected = compute_hazard_at_poe(ghaz.poe, *self._curves[loc], 50)
+                    assert np.isclose(ghaz.grid_poes[i], expected)
+
+        for ghaz_cov, ghaz in zip(ghazs[:2], ghazs[2:]):
+            for i, loc in enumerate(self._location_keys):
+                if loc in self._covs:
+                    levels, covs = self._covs[loc]
+                    expected = np.exp(np.interp(np.log(ghaz.grid_poes[i]), np.log(levels), np.log(covs)))
+                    assert np.isclose(ghaz_cov.grid_poes[i], expected)
+
+
+def gridded_hazard(poe, grid_poes):
+    return model.GriddedHazard.new_model(
+        hazard_model_id='MODEL', location_grid_id='GRID', vs30=400, imt='PGA', agg='mean', poe=poe, grid_poes=grid_poes
+    )
+
+
+@mock.patch.object(model.GriddedHazard, 'save', autospec=True)
+@mock.patch.object(model.GriddedHazard, 'query')
+@mock.patch.object(model.GriddedHazard, 'batch_write')
+class TestSaveGriddedHazard(unittest.TestCase):
+    def setUp(self):
+        self._new = gridded_hazard(0.02, [1.0, None])
+        self._existing = gridded_hazard(0.1, [2.0, None])
+        self._old = gridded_hazard(0.1, [3.0, 3.0])
+
+    def test_batch_save(self, mock_batch_write, mock_query, mock_save):
+
+        mock_query.return_value = iter([self._old])
+        save_gridded_hazard([self._new, self._existing], {self._existing.sort_key})
+
+        # new rows are batched, existing rows are updated with a versioned save
+        batch = mock_batch_write.return_value.__enter__.return_value
+        batch.save.assert_called_once_with(self._new)
+        mock_query.assert_called_once()
+        mock_save.assert_called_once_with(self._old)
+        assert self._old.grid_poes == [2.0, None]
+
+    def test_batch_save_fallback(self, mock_batch_write, mock_query, mock_save):
+
+        mock_batch_write.return_value.__exit__.side_effect = PutError('failed')
+        mock_query.return_value = iter([])
+        save_gridded_hazard([self._new], set())
+
+        # the rows of a failed batch are saved individually
+        mock_query.assert_called_once()
+        mock_save.assert_called_once_with(self._new)
+
+
+@mock.patch('toshi_hazard_post.hazard_grid.gridded_hazard.process_and_save')
+@mock.patch('toshi_hazard_post.hazard_grid.gridded_hazard.get_existing_sort_keys')
+@mock.patch('toshi_hazard_post.hazard_grid.gridded_hazard.RegionGrid')
+class TestCalcGriddedHazard(unittest.TestCase):
+    def setUp(self):
+        self._poe_levels = [0.02, 0.1]
+        self._args = ('GRID', self._poe_levels, ['MODEL'], [400, 750], ['PGA'], ['mean'], 1)
+
+    def test_skip_existing(self, mock_grid, mock_existing_keys, mock_process_and_save):
+
+        mock_grid.__getitem__.return_value = SimpleNamespace(resolution=0.1, load=lambda: [(-41.3, 174.8)])
+        mock_existing_keys.return_value = {
+            gridded_hazard_sort_key('MODEL', 'GRID', 400, 'PGA', 'mean', poe) for poe in self._poe_levels
+        }
+
+        calc_gridded_hazard(*self._args)
+        assert [task.vs30 for (task,), _ in mock_process_and_save.call_args_list] == [750]
+
+        mock_process_and_save.reset_mock()
+        mock_existing_keys.reset_mock()
+        calc_gridded_hazard(*self._args, force=True)
+        mock_existing_keys.assert_not_called()
+        assert [task.vs30 for (task,), _ in mock_process_and_save.call_args_list] == [400, 750]
@@ -0,0 +1,33 @@
+import unittest
+
+import numpy as np
+
+from toshi_hazard_post.hazard_grid.gridded_poe import compute_hazard_at_poe, compute_hazard_at_poe_batch
+
+
+class TestHazardAtPoe(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        self._accels = np.logspace(-3, 1, 30)
+        curves = [np.sort(rng.random(30) ** rng.integers(1, 20))[::-1] * rng.random() for i in range(20)]
+        not_monotonic = curves[0].copy()
+        not_monotonic[[3, 4]] = not_monotonic[[4, 3]]
+        curves += [np.zeros(30), np.full(30, 0.9), not_monotonic]
+        self._poes = np.array(curves)
+
+    def test_compute_hazard_at_poe_batch(self):
+
+        for poe in [0.02, 0.1, 0.9999]:
+            hazard = compute_hazard_at_poe_batch(poe, self._accels, self._poes, 50)
+            assert hazard.shape == (self._poes.shape[0],)
+            for i, annual_poes in enumerate(self._poes):
+                try:
+                    expected = compute_hazard_at_poe(poe, list(self._accels), list(annual_poes), 50)
+                except ValueError:
+                    expected = np.nan
+                assert np.allclose(hazard[i], expected, equal_nan=True)
+
+        # all zero curves are 0.0, empty or unmonotonic trimmed curves are NaN
+        assert hazard[-3] == 0.0
+        assert np.isnan(hazard[-2])
+        assert np.isnan(hazard[-1])
@@ -1,3 +1,4 @@
+from math import isclose
 from pathlib import Path
 import json
 from unittest import mock, TestCase
@@ -6,8 +7,9 @@ from typing import List
 from dacite import from_dict
 
 from nzshm_model.source_logic_tree.logic_tree import FlattenedSourceLogicTree
+from toshi_hazard_post.logic_tree.branch_combinator import get_logic_trees
 from toshi_hazard_post.toshi_api_support import SourceSolutionMap
-from toshi_hazard_post.logic_tree.logic_tree import HazardLogicTree, GMCMBranch
+from toshi_hazard_post.logic_tree.logic_tree import HazardBranch, HazardLogicTree, GMCMBranch, get_source_solution_map
 
 
 def test_sourcesolutionmap():
@@ -67,6 +69,8 @@ def expected_gmcm_branches() -> List[GMCMBranch]:
 @mock.patch('toshi_hazard_post.logic_tree.logic_tree.toshi_api.get_hazard_gt')
 class TestHazardLogicTree(TestCase):
     def setUp(self):
+        get_source_solution_map.cache_clear()
+
         flat_lt_filepath = Path(Path(__file__).parent, 'fixtures/logic_tree', 'flattened_lt.json')
         with open(flat_lt_filepath) as flat_lt_file:
             data = json.load(flat_lt_file)
@@ -96,6 +100,15 @@ class TestHazardLogicTree(TestCase):
         expected = [branch for branch in self.flattened_lt.branches]
         assert comp_branches == expected
 
+    def test_gt_query_cached(self, mock_api):
+
+        mock_api.return_value = mock_source_solution_map()
+
+        # building logic trees for more than one vs30 should only query the ToshiAPI once per GT ID
+        HazardLogicTree.from_flattened_slt(self.flattened_lt, ['mock'])
+        HazardLogicTree.from_flattened_slt(self.flattened_lt, ['mock'])
+        mock_api.assert_called_once_with('mock')
+
     def test_set_gmm_branches(self, mock_api):
 
         mock_api.return_value = mock_source_solution_map()
@@ -108,3 +121,78 @@ class TestHazardLogicTree(TestCase):
 
         # check that the gmcm_branches are correct
         assert logic_tree.branches[0].gmcm_branches == expected_gmcm_branches()
+
+        # check that the realizations used by the gmcm_branches are found for each hazard id
+        logic_tree.branches = logic_tree.branches[:1]
+        assert logic_tree.hazard_realizations == {'hazsol_0': [0, 1, 2], 'hazsol_3': [0, 1]}
+
+
+def test_set_gmm_branches_correlated():
+
+    metadata = {
+        'hazsol_A': {
+            'trt': {'0': 'trtA', '1': 'trtA'},
+            'uncertainty': {'0': 'gsimA0', '1': 'gsimA1'},
+            'weight': {'0': 0.4, '1': 0.6},
+        },
+        'hazsol_B': {
+            'trt': {'0': 'trtB', '1': 'trtB'},
+            'uncertainty': {'0': 'gsimB0', '1': 'gsimB1'},
+            'weight': {'0': 0.5, '1': 0.5},
+        },
+        'hazsol_C': {
+            'trt': {'0': 'trtC', '1': 'trtC'},
+            'uncertainty': {'0': 'gsimC0', '1': 'gsimC1'},
+            'weight': {'0': 0.3, '1': 0.7},
+        },
+    }
+    branch = HazardBranch(None, ['hazsol_A', 'hazsol_B', 'hazsol_C'])
+    branch.set_gmcm_branches(metadata, [['gsimA0', 'gsimB0'], ['gsimA1', 'gsimB1']])
+
+    # the puppet gsims (trtB) take the weight of their master (trtA) and only correlated combinations are kept
+    expected = [
+        GMCMBranch(['hazsol_A:0', 'hazsol_B:0', 'hazsol_C:0'], 0.4 * 0.3),
+        GMCMBranch(['hazsol_A:0', 'hazsol_B:0', 'hazsol_C:1'], 0.4 * 0.7),
+        GMCMBranch(['hazsol_A:1', 'hazsol_B:1', 'hazsol_C:0'], 0.6 * 0.3),
+        GMCMBranch(['hazsol_A:1', 'hazsol_B:1', 'hazsol_C:1'], 0.6 * 0.7),
+    ]
+    assert [gmcm_branch.realizations for gmcm_branch in branch.gmcm_branches] == [
+        gmcm_branch.realizations for gmcm_branch in expected
+    ]
+    assert all(isclose(gmcm_branch.weight, exp.weight) for gmcm_branch, exp in zip(branch.gmcm_branches, expected))
+
+
+@mock.patch('toshi_hazard_post.logic_tree.logic_tree.toshi_api.get_hazard_gt')
+class TestGetLogicTrees(TestCase):
+    def setUp(self):
+        get_source_solution_map.cache_clear()
+
+        flat_lt_filepath = Path(Path(__file__).parent, 'fixtures/logic_tree', 'flattened_lt.json')
+        with open(flat_lt_filepath) as flat_lt_file:
+            self.flattened_lt = from_dict(data_class=FlattenedSourceLogicTree, data=json.load(flat_lt_file))
+
+        metadata_filepath = Path(Path(__file__).parent, 'fixtures/logic_tree', 'metadata.json')
+        with open(metadata_filepath) as mdf:
+            metadata = json.load(mdf)
+        # hazsol_0-2 are trtA, hazsol_3-5 are trtB, with different trtA weights for each vs30
+        self.metadata = {
+            400: {f'hazsol_{i}': metadata['hazsol_0'] if i < 3 else metadata['hazsol_3'] for i in range(6)},
+            750: {f'hazsol_{i}': metadata['hazsol_0'] if i < 3 else metadata['hazsol_3'] for i in range(6)},
+        }
+        self.metadata[750]['hazsol_0'] = dict(metadata['hazsol_0'], weight={'0': 0.5, '1': 0.25, '2': 0.25})
+
+    def test_parallel(self, mock_api):
+
+        mock_api.return_value = mock_source_solution_map()
+        with mock.patch(
+            'toshi_hazard_post.logic_tree.branch_combinator.load_flattened_slt', return_value=self.flattened_lt
+        ), mock.patch(
+            'toshi_hazard_post.logic_tree.branch_combinator.preload_meta',
+            side_effect=lambda ids, vs30: self.metadata[vs30],
+        ):
+            serial = get_logic_trees('lt_config', ['mock'], [400, 750], [], num_workers=1)
+            parallel = get_logic_trees('lt_config', ['mock'], [400, 750], [], num_workers=2)
+
+        assert serial == parallel
+        assert serial[400].branches[0].gmcm_branches == expected_gmcm_branches()
+        assert serial[750].branches[0].gmcm_branches != expected_gmcm_branches()
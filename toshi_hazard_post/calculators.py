@@ -6,14 +6,18 @@ from typing import List, Tuple, Union
 
 import numpy as np
 import numpy.typing as npt
-from numba import jit
+from numba import float64, jit, vectorize
 
 log = logging.getLogger(__name__)
 
+# the number of columns branch_stats sums at once
+BRANCH_STATS_BLOCK = 64
 
-@jit(nopython=True)
+
+@vectorize([float64(float64, float64)], nopython=True)
 def prob_to_rate(prob: npt.NDArray, inv_time: float) -> npt.NDArray:
-    """Convert probability of exceedance to rate assuming Poisson distribution.
+    """Convert probability of exceedance to rate assuming Poisson distribution. Compiled as a NumPy ufunc so it can
+    be applied directly to arrays of any shape.
 
     Parameters
     ----------
@@ -28,12 +32,13 @@ def prob_to_rate(prob: npt.NDArray, inv_time: float) -> npt.NDArray:
         return rate in inv_time
     """
 
-    return -np.log(1.0 - prob) / inv_time
+    return -np.log1p(-prob) / inv_time
 
 
-@jit(nopython=True)
+@vectorize([float64(float64, float64)], nopython=True)
 def rate_to_prob(rate: npt.NDArray, inv_time: float) -> npt.NDArray:
-    """Convert rate to probabiility of exceedance assuming Poisson distribution.
+    """Convert rate to probabiility of exceedance assuming Poisson distribution. Compiled as a NumPy ufunc so it can
+    be applied directly to arrays of any shape.
 
     Parameters
     ----------
@@ -48,7 +53,99 @@ def rate_to_prob(rate: npt.NDArray, inv_time: float) -> npt.NDArray:
         probability of exceedance in inv_time
     """
 
-    return 1.0 - np.exp(-inv_time * rate)
+    return -np.expm1(-inv_time * rate)
+
+
+@jit(nopython=True, cache=True)
+def sum_rows_by_branch(table: npt.NDArray, rows: npt.NDArray, offsets: npt.NDArray) -> npt.NDArray:
+    """Sum groups of rows of a 2D array without materialising the gathered rows.
+
+    Parameters
+    ----------
+    table
+        2D array of values (e.g. component rates), rows are summed
+    rows
+        row indices of table in branch order
+    offsets
+        start of each branch in rows followed by len(rows), so that branch i sums table[rows[offsets[i]:offsets[i+1]]]
+
+    Returns
+    -------
+    sums
+        axis0 = branch
+        axis1 = column of table
+    """
+
+    nbranches = len(offsets) - 1
+    ncols = table.shape[1]
+    sums = np.zeros((nbranches, ncols))
+    for i in range(nbranches):
+        for j in range(offsets[i], offsets[i + 1]):
+            row = rows[j]
+            for k in range(ncols):
+                sums[i, k] += table[row, k]
+    return sums
+
+
+@jit(nopython=True, cache=True)
+def branch_stats(
+    table: npt.NDArray, rows: npt.NDArray, offsets: npt.NDArray, weights: npt.NDArray, quantiles: npt.NDArray
+) -> Tuple[npt.NDArray, npt.NDArray, npt.NDArray]:
+    """Sum groups of rows of a 2D array (as sum_rows_by_branch) and find the weighted mean, standard deviation, and
+    quantiles of the sums. The sums are taken for a block of BRANCH_STATS_BLOCK columns at a time so that each row of
+    table is read contiguously while only a block of branch sums is held in memory.
+
+    Parameters
+    ----------
+    table
+        2D array of values (e.g. component rates), rows are summed
+    rows
+        row indices of table in branch order
+    offsets
+        start of each branch in rows followed by len(rows)
+    weights
+        weight of each branch, must sum to 1
+    quantiles
+        quantiles to be found. Values should be in [0,1]
+
+    Returns
+    -------
+    mean
+        weighted mean of each column
+    std
+        weighted standard deviation of each column
+    weighted_quantiles
+        axis 0 = quantile
+        axis 1 = column of table
+    """
+
+    nbranches = len(offsets) - 1
+    ncols = table.shape[1]
+    mean = np.empty(ncols)
+    std = np.empty(ncols)
+    wq = np.empty((len(quantiles), ncols))
+    block_sums = np.empty((nbranches, BRANCH_STATS_BLOCK))
+    for start in range(0, ncols, BRANCH_STATS_BLOCK):
+        stop = min(start + BRANCH_STATS_BLOCK, ncols)
+        block_sums[:] = 0.0
+        for i in range(nbranches):
+            for j in range(offsets[i], offsets[i + 1]):
+                row = rows[j]
+                for k in range(start, stop):
+                    block_sums[i, k - start] += table[row, k]
+
+        for k in range(start, stop):
+            branch_sums = block_sums[:, k - start].copy()
+            mean[k] = np.sum(weights * branch_sums)
+            std[k] = np.sqrt(np.sum(weights * (branch_sums - mean[k]) ** 2))
+
+            if len(quantiles):
+                sorter = np.argsort(branch_sums)
+                sorted_weights = weights[sorter]
+                weighted_quantiles = np.cumsum(sorted_weights) - 0.5 * sorted_weights
+                wq[:, k] = np.interp(quantiles, weighted_quantiles, branch_sums[sorter])
+
+    return mean, std, wq
 
 
 def weighted_avg_and_std(values: npt.NDArray, weights: npt.NDArray) -> Tuple[np.double, float]:
@@ -105,3 +202,57 @@ def calculate_weighted_quantiles(
     wq = np.interp(quantiles, weighted_quantiles, values)
 
     return wq
+
+
+def calculate_weighted_quantiles_2d(
+    values: npt.NDArray, weights: npt.NDArray, quantiles: Union[List[float], npt.NDArray]
+) -> npt.NDArray:
+    """Calculate weighed quantiles of every column of a 2D array. Equivalent to calling
+    calculate_weighted_quantiles on each column, but all columns are sorted and interpolated at once.
+
+    Parameters
+    ----------
+    values
+        values of data, quantiles are taken across axis 0
+    weights
+        weights of values. Same length as axis 0 of values
+    quantiles
+        quantiles to be found. Values should be in [0,1]
+
+    Returns
+    -------
+    weighed_quantiles
+        weighed quantiles
+        axis 0 = quantile
+        axis 1 = column of values
+    """
+
+    nrows, ncols = values.shape
+    if nrows == 1:
+        return np.repeat(values, len(quantiles), axis=0)
+
+    sorter = np.argsort(values, axis=0)
+    values = np.take_along_axis(values, sorter, axis=0)
+    weights = weights[sorter]
+
+    weighted_quantiles = np.cumsum(weights, axis=0) - 0.5 * weights
+    weighted_quantiles /= np.sum(weights, axis=0)
+
+    # the weighted quantiles are in [0, 1], so offsetting each column by 2 * column gives a single sorted array
+    # and one searchsorted call finds the bracketing rows for every quantile and column
+    cols = np.arange(ncols)
+    quantiles = np.asarray(quantiles, dtype=float)
+    offsets = 2.0 * cols
+    flat = (weighted_quantiles + offsets).ravel(order='F')
+    ind = np.searchsorted(flat, quantiles[:, None] + offsets, side='right') - cols * nrows
+    ind = np.clip(ind - 1, 0, nrows - 2)
+
+    # linear interpolation matching np.interp, including clamping to the end values outside the weighted range
+    x0, x1 = weighted_quantiles[ind, cols], weighted_quantiles[ind + 1, cols]
+    y0, y1 = values[ind, cols], values[ind + 1, cols]
+    dx = x1 - x0
+    q = quantiles[:, None]
+    frac = np.where(dx > 0, (q - x0) / np.where(dx > 0, dx, 1.0), q >= x1)
+    wq = y0 + np.clip(frac, 0.0, 1.0) * (y1 - y0)
+
+    return wq
@@ -1,7 +1,8 @@
+import itertools
 import logging
 import time
 from collections import namedtuple
-from typing import Any, Dict, List, Set
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 import numpy as np
 import numpy.typing as npt
@@ -18,40 +19,85 @@ INV_TIME = 1.0
 log = logging.getLogger(__name__)
 
 
-# TODO: split rlz number from id rather than joining in key, could keep interface the same and then transition to
-# no longer using id:rlz keys later
 class ValueStore:
-    """storage class for individual oq data from THS. This results in ~15-20% performance hit when calculating
-    aggregations on a 44 element array, but the interface is far superior to 3x nested dicts"""
+    """storage class for individual oq data from THS. Values are stored as rows of a single 2D array (one row per
+    hazard id, realization, location, imt) with a dict mapping keys to rows. Hazard IDs and locations are dictionary
+    encoded per row so metadata queries don't need to scan every key.
 
-    DictKey = namedtuple("DictKey", "key loc imt")
+    Values are stored as float32 to halve the memory and bandwidth of the store; sums and statistics taken over them are
+    accumulated in float64."""
 
-    def __init__(self) -> None:
-        self._values: Dict[ValueStore.DictKey, npt.NDArray] = {}
+    DictKey = namedtuple("DictKey", "hazard_id rlz loc imt")
+    DTYPE = np.float32
 
-    def set_values(self, *, value: npt.NDArray, key: str, loc: str, imt: str) -> None:
-        self._values[ValueStore.DictKey(key=key, loc=loc, imt=imt)] = value
+    def __init__(self) -> None:
+        self._rows: Dict[ValueStore.DictKey, int] = {}
+        self._values: npt.NDArray = np.empty((0, 0), dtype=ValueStore.DTYPE)
+        self._id_codes: Dict[str, int] = {}
+        self._loc_codes: Dict[str, int] = {}
+        self._ids: npt.NDArray = np.empty((0,), dtype=np.int32)
+        self._locs: npt.NDArray = np.empty((0,), dtype=np.int32)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _grow(self, ncols: int) -> None:
+        nrows = max(2 * self._values.shape[0], 64)
+        values = np.empty((nrows, ncols), dtype=ValueStore.DTYPE)
+        if len(self):
+            values[: len(self)] = self._values[: len(self)]
+        self._values = values
+        self._ids = np.resize(self._ids, nrows)
+        self._locs = np.resize(self._locs, nrows)
+
+    def set_values(self, *, value: npt.NDArray, hazard_id: str, rlz: str, loc: str, imt: str) -> None:
+        dict_key = ValueStore.DictKey(hazard_id=hazard_id, rlz=rlz, loc=loc, imt=imt)
+        row = self._rows.get(dict_key)
+        if row is None:
+            row = len(self)
+            if row == self._values.shape[0]:
+                self._grow(len(value))
+            self._rows[dict_key] = row
+            self._ids[row] = self._id_codes.setdefault(hazard_id, len(self._id_codes))
+            self._locs[row] = self._loc_codes.setdefault(loc, len(self._loc_codes))
+        self._values[row, :] = value
+
+    def values(self, *, hazard_id: str, rlz: str, loc: str, imt: str) -> npt.NDArray:
+        return self._values[self._rows[ValueStore.DictKey(hazard_id=hazard_id, rlz=rlz, loc=loc, imt=imt)]]
+
+    def rows(self, rlzs: List[Tuple[str, str]], loc: str, imt: str) -> npt.NDArray:
+        """The rows of array holding the (hazard_id, rlz) realizations at a location and imt."""
+        return np.array([self._rows[ValueStore.DictKey(hazard_id, rlz, loc, imt)] for hazard_id, rlz in rlzs])
 
-    def values(self, *, key: str, loc: str, imt: str) -> npt.NDArray:
-        return self._values[ValueStore.DictKey(key=key, loc=loc, imt=imt)]
+    @property
+    def array(self) -> npt.NDArray:
+        """All stored values, one row per key. Rows are found with rows()."""
+        return self._values[: len(self)]
 
     @property
     def len_rate(self) -> int:
-        return len(next(iter(self._values.values())))
+        return self._values.shape[1]
 
     @property
     def toshi_hazard_ids(self) -> Set[str]:
-        ids = []
-        for k in self._values.keys():
-            ids.append(k.key.split(':')[0])
-        return set(ids)
+        return set(self._id_codes.keys())
 
     def locs(self, toshi_hazard_id: str) -> Set[str]:
-        lcs = []
-        for k in self._values.keys():
-            if k.key.split(':')[0] == toshi_hazard_id:
-                lcs.append(k.loc)
-        return set(lcs)
+        if toshi_hazard_id not in self._id_codes:
+            return set()
+        loc_names = list(self._loc_codes.keys())
+        id_rows = self._ids[: len(self)] == self._id_codes[toshi_hazard_id]
+        return {loc_names[code] for code in np.unique(self._locs[: len(self)][id_rows])}
+
+    def locs_by_id(self) -> Dict[str, Set[str]]:
+        """The locations stored for every hazard id, found in a single pass over the rows."""
+        id_names = list(self._id_codes.keys())
+        loc_names = list(self._loc_codes.keys())
+        nlocs = len(loc_names)
+        id_locs: Dict[str, Set[str]] = {id: set() for id in id_names}
+        for code in np.unique(self._ids[: len(self)].astype(np.int64) * nlocs + self._locs[: len(self)]):
+            id_locs[id_names[code // nlocs]].add(loc_names[code % nlocs])
+        return id_locs
 
 
 def get_levels(logic_tree: HazardLogicTree, locs: List[str], vs30: int, imts: List[str]) -> Any:
@@ -123,12 +169,14 @@ def check_values(values: ValueStore, toshi_hazard_ids: List[str], locs: List[str
         locations that should be present
     """
 
-    diff_ids = set(toshi_hazard_ids) - values.toshi_hazard_ids
+    id_locs = values.locs_by_id()
+    diff_ids = set(toshi_hazard_ids) - id_locs.keys()
     if diff_ids:
         log.warn('missing ids: %s' % diff_ids)
 
+    locs_set = set(locs)
     for id in toshi_hazard_ids:
-        diff_locs = set(locs) - values.locs(id)
+        diff_locs = locs_set - id_locs.get(id, set())
         if diff_locs:
             log.warn('missing locations: %s for id %s' % (diff_locs, id))
 
@@ -150,7 +198,13 @@ def get_site_vs30(toshi_ids: List[str], loc: str) -> float:
     return res.site_vs30
 
 
-def load_realization_values(toshi_ids: List[str], locs: List[str], vs30s: List[int], imts: List[str]) -> ValueStore:
+def load_realization_values(
+    toshi_ids: List[str],
+    locs: List[str],
+    vs30s: List[int],
+    imts: List[str],
+    rlzs: Optional[Dict[str, List[int]]] = None,
+) -> ValueStore:
     """Load hazard curves from Toshi-Hazard-Store.
 
     Parameters
@@ -161,22 +215,45 @@ def load_realization_values(toshi_ids: List[str], locs: List[str], vs30s: List[i
         coded location strings
     vs30s
         vs30s
+    imts
+        intensity measure types
+    rlzs
+        gsim realization numbers to load for each Toshi ID. THS is queried once per realization so only requesting
+        the realizations used by the logic tree avoids queries for realizations that don't exist. If not provided
+        realizations 0-20 are requested for every ID, as they are (with a warning) for an ID missing from rlzs.
 
     Returns
     values
         hazard curve values (probabilities) keyed by Toshi ID and gsim realization number
     """
 
+    # group ids that share the same realizations so they can be requested in a single query
+    id_groups: Dict[Tuple[int, ...], List[str]] = {}
+    all_rlzs = tuple(range(21))
+    for toshi_id in toshi_ids:
+        if not rlzs:
+            id_rlzs = all_rlzs
+        elif toshi_id in rlzs:
+            id_rlzs = tuple(rlzs[toshi_id])
+        else:
+            log.warning('no realizations given for hazard id %s, requesting realizations 0-20' % toshi_id)
+            id_rlzs = all_rlzs
+        id_groups.setdefault(id_rlzs, []).append(toshi_id)
+    results = itertools.chain.from_iterable(
+        toshi_hazard_store.query_v3.get_rlz_curves_v3(locs, vs30s, list(group_rlzs), group_ids, imts)
+        for group_rlzs, group_ids in id_groups.items()
+    )
+
     log.info('loading %s hazard IDs ... ' % len(toshi_ids))
     values = ValueStore()
     tic = time.perf_counter()
     try:
-        for res in toshi_hazard_store.query_v3.get_rlz_curves_v3(locs, vs30s, list(range(21)), toshi_ids, imts):
-            key = ':'.join((res.hazard_solution_id, str(res.rlz)))
-            for val in res.values:
-                values.set_values(
-                    value=prob_to_rate(np.array(val.vals), INV_TIME), key=key, loc=res.nloc_001, imt=val.imt
-                )
+        for res in results:
+            rlz = str(res.rlz)
+            # convert the curves for all imts of the realization in a single call
+            rates = prob_to_rate(np.array([val.vals for val in res.values], dtype=np.float64), INV_TIME)
+            for val, rate in zip(res.values, rates):
+                values.set_values(value=rate, hazard_id=res.hazard_solution_id, rlz=rlz, loc=res.nloc_001, imt=val.imt)
     except Exception as err:
         logging.warning(
             'load_realization_values() got exception %s with toshi_ids: %s , locs: %s vs30s: %s'
@@ -225,14 +302,20 @@ def load_realization_values_deagg(toshi_ids, locs, vs30s, deagg_dimensions):
         hazard_solution_id = download['hazard_id']
         disaggs, bins, location, imt = get_disagg(csv_archive, deagg_dimensions)
         log.info(f'finished loading data from csv archive {i+1} of {len(downloads)}')
-        for rlz in disaggs.keys():
-            key = ':'.join((hazard_solution_id, rlz))
-            values.set_values(value=prob_to_rate(np.array(disaggs[rlz]), INV_TIME), key=key, loc=location, imt=imt)
+        for rlz, disagg in disaggs.items():
+            # disagg arrays are not used elsewhere so convert to rate in place rather than allocating a copy
+            values.set_values(
+                value=prob_to_rate(disagg, INV_TIME, out=disagg),
+                hazard_id=hazard_solution_id,
+                rlz=rlz,
+                loc=location,
+                imt=imt,
+            )
 
     # check that the correct number of records came back
     check_values(values, toshi_ids, locs)
 
     toc = time.perf_counter()
-    print(f'time to load realizations: {toc-tic:.1f} seconds')
+    log.debug(f'time to load realizations: {toc-tic:.1f} seconds')
 
     return values, bins
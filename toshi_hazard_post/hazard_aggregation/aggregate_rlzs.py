@@ -1,11 +1,18 @@
 import logging
 import time
-from typing import List, Optional
+from collections import namedtuple
+from typing import Dict, List, Optional
 
 import numpy as np
 import numpy.typing as npt
 
-from toshi_hazard_post.calculators import calculate_weighted_quantiles, weighted_avg_and_std
+from toshi_hazard_post.calculators import (
+    branch_stats,
+    calculate_weighted_quantiles,
+    calculate_weighted_quantiles_2d,
+    sum_rows_by_branch,
+    weighted_avg_and_std,
+)
 from toshi_hazard_post.data_functions import ValueStore
 from toshi_hazard_post.logic_tree.logic_tree import GMCMBranch, HazardLogicTree
 
@@ -15,6 +22,8 @@ VERBOSE = True
 
 log = logging.getLogger(__name__)
 
+RealizationIndex = namedtuple("RealizationIndex", "rlzs rows offsets")
+
 
 def weighted_stats(
     values: npt.NDArray,
@@ -42,7 +51,9 @@ def weighted_stats(
         statistics in same order as quantiles
     """
 
-    tic = time.perf_counter()
+    debug = log.isEnabledFor(logging.DEBUG)
+    if debug:
+        tic = time.perf_counter()
 
     if sample_weight is None:
         sample_weight = np.ones(len(values))
@@ -81,12 +92,46 @@ def weighted_stats(
     if get_mean:
         wq = np.append(np.append(wq[0:mean_ind], np.array([mean])), wq[mean_ind:])
 
-    toc = time.perf_counter()
-    log.debug(f'time to calculate weighted quantiles {toc-tic} seconds')
+    if debug:
+        log.debug('time to calculate weighted quantiles %s seconds' % (time.perf_counter() - tic))
 
     return wq
 
 
+def get_realization_index(gmcm_branches: List[GMCMBranch]) -> RealizationIndex:
+    """Map each unique realization to a row of the component table and each gmcm branch to its rows. The index
+    depends only on the logic tree so it can be built once and reused for every location, imt, and stride.
+
+    Parameters
+    ----------
+    gmcm_branches
+        the gmcm branches to index
+
+    Returns
+    -------
+    rlz_index
+        rlzs: the unique (ToshiID, gsim_realization) pairs in row order
+        rows: component table row of every realization of every branch
+        offsets: start of each branch in rows with a trailing len(rows)
+    """
+
+    # the sizes are known from the branches so the arrays are built at their final size rather than grown as lists
+    offsets = np.empty(len(gmcm_branches) + 1, dtype=np.int32)
+    offsets[0] = 0
+    offsets[1:] = np.cumsum([len(gmcm_branch.realizations) for gmcm_branch in gmcm_branches])
+
+    rlz_rows: Dict[str, int] = {}
+    branch_rows = np.fromiter(
+        (rlz_rows.setdefault(rlz, len(rlz_rows)) for gmcm_branch in gmcm_branches for rlz in gmcm_branch.realizations),
+        dtype=np.int32,
+        count=offsets[-1],
+    )
+
+    # split the ToshiID:gsim_realization keys once here rather than on every ValueStore lookup
+    rlzs = [tuple(rlz.split(':')) for rlz in rlz_rows]
+    return RealizationIndex(rlzs, branch_rows, offsets)
+
+
 def calc_weighted_sum(
     gmcm_branches: List[GMCMBranch], values: ValueStore, loc: str, imt: str, start_ind: int, end_ind: int
 ) -> npt.NDArray:
@@ -115,19 +160,39 @@ def calc_weighted_sum(
         axis1 = probability array
     """
 
-    nrows = len(gmcm_branches)
-    ncols = end_ind - start_ind
-    sum_table = np.empty((nrows, ncols))
+    return sum_indexed_realizations(get_realization_index(gmcm_branches), values, loc, imt, start_ind, end_ind)
+
+
+def sum_indexed_realizations(
+    rlz_index: RealizationIndex, values: ValueStore, loc: str, imt: str, start_ind: int, end_ind: int
+) -> npt.NDArray:
+    """Sum the realizations of every branch of a pre-built realization index.
+
+    Parameters
+    ----------
+    rlz_index
+        index of the branches from get_realization_index
+    values
+        probability values
+    loc
+        coded location
+    imt
+        intensity measure type
+    start_ind
+        start index of probability array to work on
+    end_ind
+        end index of probability array to work on
 
-    for i, gmcm_branch in enumerate(gmcm_branches):
-        rate = np.zeros((ncols,))
-        for rlz in gmcm_branch.realizations:
-            # rate += prob_to_rate(values.values(key=rlz, loc=loc, imt=imt)[start_ind:end_ind], INV_TIME)
-            rate += values.values(key=rlz, loc=loc, imt=imt)[start_ind:end_ind]
-        # prob = rate_to_prob(rate, INV_TIME)
-        sum_table[i, :] = rate
+    Returns
+    -------
+    probability
+        axis0 = realization combination
+        axis1 = probability array
+    """
 
-    return sum_table
+    # sum straight out of the ValueStore array rather than first copying each realization into a component table
+    value_rows = values.rows(rlz_index.rlzs, loc, imt)[rlz_index.rows]
+    return sum_rows_by_branch(values.array[:, start_ind:end_ind], value_rows, rlz_index.offsets)
 
 
 def calculate_aggs(branch_values: npt.NDArray, aggs: List[str], weight_combs: npt.NDArray) -> npt.NDArray:
@@ -155,19 +220,87 @@ def calculate_aggs(branch_values: npt.NDArray, aggs: List[str], weight_combs: np
         axis 1 = aggs
     """
 
-    # TODO: eliminate redundant prob-->rate-->prop conversion
+    # all columns are aggregated at once rather than calling weighted_stats on each column
+    weights = weight_combs / np.sum(weight_combs)
+    quants = get_quantiles(aggs)
+
+    mean = weights @ branch_values
+    std = np.sqrt(weights @ (branch_values - mean) ** 2)
+    wq = calculate_weighted_quantiles_2d(branch_values, weights, quants)
+
+    return _stats_table(aggs, branch_values.shape[1], mean, std, wq)
+
+
+def get_quantiles(aggs: List[str]) -> npt.NDArray:
+    """The quantiles requested in aggs (all aggs other than 'mean', 'std', and 'cov') in the order they appear."""
+
+    quants = np.array([float(agg) for agg in aggs if agg not in ('mean', 'std', 'cov')])
+    assert np.all(quants >= 0) and np.all(quants <= 1), 'quantiles should be in [0, 1]'
+    return quants
+
+
+def _stats_table(
+    aggs: List[str], nrows: int, mean: npt.NDArray, std: npt.NDArray, weighted_quantiles: npt.NDArray
+) -> npt.NDArray:
+    """Arrange the mean, std, cov, and quantiles into columns in the order of aggs."""
+
+    stats = np.empty((nrows, len(aggs)))
+    for i, agg in enumerate(aggs):
+        if agg == 'mean':
+            stats[:, i] = mean
+        elif agg == 'std':
+            stats[:, i] = std
+        elif agg == 'cov':
+            stats[:, i] = np.divide(std, mean, out=np.zeros(nrows), where=mean > 0.0)
+
+    quantile_inds = [i for i, agg in enumerate(aggs) if agg not in ('mean', 'std', 'cov')]
+    if quantile_inds:
+        stats[:, quantile_inds] = weighted_quantiles.T
+
+    return stats
+
+
+def calculate_hazard(
+    rlz_index: RealizationIndex,
+    values: ValueStore,
+    loc: str,
+    imt: str,
+    aggs: List[str],
+    weight_combs: npt.NDArray,
+) -> npt.NDArray:
+    """Calculate the aggregate statistics of the full, combined logic tree at one location and imt. Equivalent to
+    calculate_aggs(build_branches(...)) over the whole curve, but the branch values are summed and aggregated a column
+    at a time in a single compiled kernel so the branch table is never built.
+
+    Parameters
+    ----------
+    rlz_index
+        index of the gmcm branches of all source branches (see get_logic_tree_index)
+    values
+        rate values
+    loc
+        coded location
+    imt
+        intensity measure type
+    aggs
+        aggregate statistics of interest (see calculate_aggs)
+    weight_combs
+        weights of the branches of rlz_index
 
-    # branch_probs = prob_to_rate(branch_probs, INV_TIME)
+    Returns
+    -------
+    rates
+        element by element aggregate statistics
+        axis 0 = rate curve (e.g. values of hazard curve)
+        axis 1 = aggs
+    """
 
-    nrows = branch_values.shape[1]
-    ncols = len(aggs)
-    median = np.empty((nrows, ncols))
-    for i in range(nrows):
-        quantiles = weighted_stats(branch_values[:, i], aggs, sample_weight=weight_combs)
-        median[i, :] = np.array(quantiles)
+    weights = weight_combs / np.sum(weight_combs)
+    quants = get_quantiles(aggs)
+    value_rows = values.rows(rlz_index.rlzs, loc, imt)[rlz_index.rows]
+    mean, std, wq = branch_stats(values.array, value_rows, rlz_index.offsets, weights, quants)
 
-    # return rate_to_prob(median, INV_TIME)
-    return median
+    return _stats_table(aggs, values.len_rate, mean, std, wq)
 
 
 # def get_len_rate(values: Dict[str, dict]) -> int:
@@ -198,8 +331,8 @@ def get_branch_weights(logic_tree: HazardLogicTree) -> npt.NDArray:
 
     Parameters
     ----------
-    source_branches
-        all source branches of complete logic tree
+    logic_tree
+        the complete logic tree
 
     Returns
     -------
@@ -207,19 +340,30 @@ def get_branch_weights(logic_tree: HazardLogicTree) -> npt.NDArray:
         multiplicitive weights of all branches of full, combined logic tree
     """
 
-    # nbranches = len(logic_tree.branches)  # TODO: should these be properties?
-    # nrows = len(logic_tree.branches[0].gmcm_branches) * nbranches
-    nrows = sum([len(branch.gmcm_branches) for branch in logic_tree.branches])
-    weights = np.empty((nrows,))
-    i = 0
-    # for i, branch in enumerate(logic_tree.branches):
-    for branch in logic_tree.branches:
-        w = np.array(branch.gmcm_branch_weights) * branch.weight
-        # weights[i * len(w) : (i + 1) * len(w)] = w
-        weights[i:i + len(w)] = w
-        i += len(w)
+    nrows = sum(len(branch.gmcm_branches) for branch in logic_tree.branches)
+    return np.fromiter(
+        (branch.weight * gmcm_branch.weight for branch in logic_tree.branches for gmcm_branch in branch.gmcm_branches),
+        dtype=np.float64,
+        count=nrows,
+    )
 
-    return weights
+
+def get_logic_tree_index(logic_tree: HazardLogicTree) -> RealizationIndex:
+    """Index the gmcm branches of all source branches together so that each realization is looked up once.
+
+    Parameters
+    ----------
+    logic_tree
+        the complete logic tree
+
+    Returns
+    -------
+    rlz_index
+        see get_realization_index
+    """
+
+    gmcm_branches = [gmcm_branch for branch in logic_tree.branches for gmcm_branch in branch.gmcm_branches]
+    return get_realization_index(gmcm_branches)
 
 
 def build_branches(
@@ -229,6 +373,7 @@ def build_branches(
     loc: str,
     start_ind: int,
     end_ind: int,
+    rlz_index: Optional[RealizationIndex] = None,
 ) -> npt.NDArray:
     """For each source branch, calculate the weighted sum probability.
 
@@ -248,6 +393,9 @@ def build_branches(
         start index of probability array to work on
     end_ind
         end index of probability array to work on
+    rlz_index
+        index of the gmcm branches of all source branches (see get_logic_tree_index). Built from logic_tree if not
+        provided.
 
     Returns
     -------
@@ -256,30 +404,14 @@ def build_branches(
         axis1 = probability array
     """
 
-    nbranches = len(logic_tree.branches)
-    # ncombs = len(logic_tree.branches[0].gmcm_branches)
-    # nrows = ncombs * nbranches
-    nrows = sum([len(branch.gmcm_branches) for branch in logic_tree.branches])
-    # ncols = get_len_rate(values)
-    ncols = end_ind - start_ind
-    branch_probs = np.empty((nrows, ncols))
-
-    tic = time.process_time()
-    # for i, branch in enumerate(logic_tree.branches):  # ~320 source branches
-    i = 0
-    for branch in logic_tree.branches:  # ~320 source branches
-        # rlz_combs, weight_combs = build_rlz_table(branch, vs30)
-
-        # set of realization probabilties for a single complete source branch
-        # these can then be aggrigated in prob space (+/- impact of NB) to create a hazard curve
-        branch_probs[i:i + len(branch.gmcm_branches) , :] = calc_weighted_sum(
-            branch.gmcm_branches, values, loc, imt, start_ind, end_ind
-        )
-        i += len(branch.gmcm_branches)
-
-        log.debug(f'built branch {i+1} of {nbranches}')
-
-    toc = time.perf_counter()
-    log.debug('build_branches took: %s ' % (toc - tic))
+    debug = log.isEnabledFor(logging.DEBUG)
+    if debug:
+        tic = time.perf_counter()
+    if rlz_index is None:
+        rlz_index = get_logic_tree_index(logic_tree)
+    branch_probs = sum_indexed_realizations(rlz_index, values, loc, imt, start_ind, end_ind)
+
+    if debug:
+        log.debug('build_branches took: %s ' % (time.perf_counter() - tic))
 
     return branch_probs
@@ -1,15 +1,19 @@
 """Hazard aggregation task dispatch."""
 import cProfile
 import logging
+import math
 import multiprocessing
 import time
-from collections import namedtuple
+from collections import deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
 from dataclasses import dataclass
-from typing import Any, Dict, Iterable, List
+from typing import Any, Deque, Dict, Iterable, List, Optional
 
 import numpy as np
 import numpy.typing as npt
 from nzshm_common.location.code_location import CodedLocation
+from pynamodb.models import BatchWrite
 from toshi_hazard_store import model
 
 from toshi_hazard_post.calculators import rate_to_prob
@@ -27,25 +31,34 @@ from toshi_hazard_post.locations import get_locations
 #     grouped_ltbs,
 #     merge_ltbs_fromLT,
 # )
-from toshi_hazard_post.logic_tree.branch_combinator import get_logic_tree
+from toshi_hazard_post.logic_tree.branch_combinator import get_logic_trees
 from toshi_hazard_post.logic_tree.logic_tree import HazardLogicTree
-from toshi_hazard_post.util.file_utils import save_realizations
+from toshi_hazard_post.util.file_utils import save_realization_logic_tree, save_realizations
 
-from .aggregate_rlzs import build_branches, calculate_aggs, get_branch_weights
+from .aggregate_rlzs import build_branches, calculate_aggs, calculate_hazard, get_branch_weights, get_logic_tree_index
 from .aggregation_config import AggregationConfig
 
 INV_TIME = 1.0
+# the most tasks to put on the task queue at once
+TASK_BATCH = 10
+# the most realization tables waiting to be written to disk, each holds a full table of branch values
+RLZ_WRITES_IN_FLIGHT = 4
 
 log = logging.getLogger(__name__)
 pr = cProfile.Profile()
 
 
+# stride is no longer used, whole curves are aggregated at once, but is kept so existing configs and task arguments
+# still work
 AggTaskArgs = namedtuple(
     "AggTaskArgs",
     """hazard_model_id grid_loc locs logic_tree aggs imts levels vs30 deagg poe deagg_imtl save_rlz
-    stride skip_save""",
+    stride skip_save weights rlz_index rlzs""",
+    defaults=(None, None, None),
 )
 
+BranchTable = namedtuple("BranchTable", "weights rlz_index rlzs")
+
 
 @dataclass
 class DistributedAggregationTaskArguments:
@@ -62,41 +75,81 @@ class DistributedAggregationTaskArguments:
 
 
 class AggregationWorkerMP(multiprocessing.Process):
-    """A worker that batches aggregation processing."""
+    """A worker that batches aggregation processing.
+
+    The logic trees are handed to the worker once when it is created. Tasks queued without a logic_tree use the
+    worker's logic tree for their vs30 so that the (large) logic tree isn't pickled through the queue with every task.
+    """
 
-    def __init__(self, task_queue: multiprocessing.JoinableQueue, result_queue: multiprocessing.Queue):
+    def __init__(
+        self,
+        task_queue: multiprocessing.JoinableQueue,
+        result_queue: multiprocessing.Queue,
+        logic_trees: Optional[Dict[int, HazardLogicTree]] = None,
+    ):
         multiprocessing.Process.__init__(self)
         self.task_queue = task_queue
         self.result_queue = result_queue
+        self.logic_trees = logic_trees if logic_trees else {}
+        self.branch_tables: Dict[int, BranchTable] = {}
+
+    def get_branch_table(self, vs30: int) -> BranchTable:
+        """The branch table of the logic tree for vs30, built the first time it is needed."""
+        if vs30 not in self.branch_tables:
+            self.branch_tables[vs30] = get_branch_table(self.logic_trees[vs30])
+        return self.branch_tables[vs30]
 
     def run(self):
         log.info("worker %s running." % self.name)
         proc_name = self.name
 
-        while True:
-            nt = self.task_queue.get()
-            if nt is None:
-                # Poison pill means shutdown
-                self.task_queue.task_done()
-                log.info('%s: Exiting' % proc_name)
-                break
-
-            try:
-                process_location_list(nt)
-                self.task_queue.task_done()
-                log.info('%s task done.' % self.name)
-                self.result_queue.put(str(nt.grid_loc))
-            except Exception as e:
-                log.error(f'unknown exception occured: {e}')
-                self.task_queue.task_done()
-                self.result_queue.put(f'FAILED {str(nt.gtid)}')
+        # tasks are queued in batches, a failed task is reported without stopping the rest of its batch
+        for batch in iter(self.task_queue.get, None):
+            for nt in batch:
+                try:
+                    if nt.logic_tree is None:
+                        weights, rlz_index, rlzs = self.get_branch_table(nt.vs30)
+                        nt = nt._replace(
+                            logic_tree=self.logic_trees[nt.vs30], weights=weights, rlz_index=rlz_index, rlzs=rlzs
+                        )
+                    process_location_list(nt)
+                    log.info('%s task done.' % self.name)
+                    self.result_queue.put(str(nt.grid_loc))
+                except Exception as e:
+                    log.error(f'unknown exception occured: {e}')
+                    self.result_queue.put(f'FAILED {str(nt.locs)}')
+            self.task_queue.task_done()
+
+        # Poison pill means shutdown
+        self.task_queue.task_done()
+        log.info('%s: Exiting' % proc_name)
+
+
+def get_branch_table(logic_tree: HazardLogicTree) -> BranchTable:
+    """Get the parts of a logic tree that every aggregation task needs. They depend only on the logic tree so are
+    built once per vs30 rather than once per task.
+
+    Parameters
+    ----------
+    logic_tree
+        the complete logic tree
+
+    Returns
+    -------
+    branch_table
+        weights: the weight of every branch of the full logic tree
+        rlz_index: the realization index of the logic tree
+        rlzs: the gsim realization numbers used by the logic tree, keyed by hazard id
+    """
+    return BranchTable(get_branch_weights(logic_tree), get_logic_tree_index(logic_tree), logic_tree.hazard_realizations)
 
 
 def process_location_list(task_args: AggTaskArgs) -> None:
     """For each imt and location, get the weighed aggregate statiscits of the hazard curve (or flattened disagg matrix)
-    realizations. This is done over STRIDE elements (default 100) of the hazard curve at a time to reduce phyisical
-    memory usage which allows for multiple calculations at once when the hazard curve is long (e.g. large
-    disaggregations).
+    realizations. The branches are summed and aggregated in blocks of BRANCH_STATS_BLOCK elements of the hazard curve
+    so at most (number of branches x BRANCH_STATS_BLOCK) branch values are held in memory, which allows for multiple
+    calculations at once when the hazard curve is long (e.g. large disaggregations). If the realizations are saved the
+    full table of branch values is built.
 
     REFACTOR.
     """
@@ -109,7 +162,6 @@ def process_location_list(task_args: AggTaskArgs) -> None:
     vs30 = task_args.vs30
     deagg_dimensions = task_args.deagg
     save_rlz = task_args.save_rlz
-    stride = task_args.stride if task_args.stride else 100
     skip_save = task_args.skip_save
     toshi_ids = logic_tree.hazard_ids
 
@@ -129,74 +181,104 @@ def process_location_list(task_args: AggTaskArgs) -> None:
     if deagg_dimensions:
         values, bins = load_realization_values_deagg(toshi_ids, locs, [vs30], deagg_dimensions[0])
     else:
-        values = load_realization_values(toshi_ids, locs, [vs30], imts)
+        rlzs = task_args.rlzs if task_args.rlzs is not None else logic_tree.hazard_realizations
+        values = load_realization_values(toshi_ids, locs, [vs30], imts, rlzs)
 
     if not values:
         log.info('missing values: %s' % (values))
         return
-    weights = get_branch_weights(logic_tree)
-    for imt in imts:
-        log.info('working on imt: %s' % imt)
-
-        tic_imt = time.perf_counter()
-        for loc in locs:
-            log.info(f'working on loc {loc}')
-            lat, lon = loc.split('~')
-            resolution = 0.001
-            location = CodedLocation(float(lat), float(lon), resolution)
-
-            site_vs30 = get_site_vs30(toshi_ids, loc) if vs30 == 0 else 0
-
-            # ncols = get_len_rate(values)
-            ncols = values.len_rate
-            hazard = np.empty((ncols, len(aggs)))
-            for start_ind in range(0, ncols, stride):
-                end_ind = start_ind + stride
-                if end_ind > ncols:
-                    end_ind = ncols
-
-                tic = time.perf_counter()
-                branch_probs = build_branches(logic_tree, values, imt, loc, start_ind, end_ind)
-                hazard[start_ind:end_ind, :] = calculate_aggs(branch_probs, aggs, weights)
-                log.info(f'time to calculate hazard for one stride {time.perf_counter() - tic} seconds')
+    # the weights and realization index only depend on the logic tree so they may be built once by the caller
+    weights = task_args.weights if task_args.weights is not None else get_branch_weights(logic_tree)
+    rlz_index = task_args.rlz_index if task_args.rlz_index is not None else get_logic_tree_index(logic_tree)
+    # timing the per-location work is only worth the overhead when it will be logged
+    debug = log.isEnabledFor(logging.DEBUG)
+
+    # site specific vs30 does not depend on imt so only query THS once per location
+    site_vs30s = {loc: get_site_vs30(toshi_ids, loc) if vs30 == 0 else 0 for loc in locs}
+    resolution = 0.001
+    coded_locations = {loc: CodedLocation(*map(float, loc.split('~')), resolution) for loc in locs}
+
+    # one batch write for all the aggregations of the task so that DynamoDB writes are sent in full batches rather
+    # than a partial batch for every location and imt
+    with ExitStack() as stack:
+        batch = None
+        if not (skip_save or deagg_dimensions):
+            batch = stack.enter_context(model.HazardAggregation.batch_write())
+
+        # realizations are written in the background so the calculation doesn't wait on disk
+        rlz_writes: Deque[Future] = deque()
+        if save_rlz:
+            io_pool = stack.enter_context(ThreadPoolExecutor(max_workers=2))
+            for loc in locs:
+                rlz_writes.append(io_pool.submit(save_realization_logic_tree, imts, loc, vs30, weights, logic_tree))
+
+        for imt in imts:
+            log.info('working on imt: %s' % imt)
+
+            tic_imt = time.perf_counter()
+            for loc in locs:
+                log.info(f'working on loc {loc}')
+                location = coded_locations[loc]
+                site_vs30 = site_vs30s[loc]
 
                 if save_rlz:
-                    save_realizations(imt, loc, vs30, branch_probs, weights, logic_tree)
-
-            if task_args.skip_save:
-                continue
-
-            if not skip_save:
-                if deagg_dimensions:
-                    # save_deaggs(
-                    #     hazard, bins, loc, imt, imtl, poe, vs30, task_args.hazard_model_id, deagg_dimensions
-                    # )  # TODO: need more information about deagg to save (e.g. poe, inv_time)
-                    save_disaggregation(
-                        aggs[0],
-                        task_args.hazard_model_id,
-                        location,
-                        imt,
-                        vs30,
-                        poe,
-                        imtl,
-                        rate_to_prob(hazard, INV_TIME),
-                        bins,
-                        deagg_dimensions[1],
-                    )
+                    # the branch values are only materialised when they are to be saved
+                    if debug:
+                        tic = time.perf_counter()
+                    branch_probs = build_branches(logic_tree, values, imt, loc, 0, values.len_rate, rlz_index)
+                    hazard = calculate_aggs(branch_probs, aggs, weights)
+                    if debug:
+                        log.debug('time to calculate hazard %s seconds' % (time.perf_counter() - tic))
+                    rlz_writes.append(io_pool.submit(save_realizations, imt, loc, vs30, branch_probs))
+                    # wait for the oldest writes so the branch tables don't pile up in memory
+                    while len(rlz_writes) > RLZ_WRITES_IN_FLIGHT:
+                        rlz_writes.popleft().result()
                 else:
-                    save_aggregation(
-                        aggs,
-                        levels,
-                        rate_to_prob(hazard, INV_TIME),
-                        imt,
-                        vs30,
-                        site_vs30,
-                        task_args.hazard_model_id,
-                        location,
-                    )
-
-        toc_imt = time.perf_counter()
-        log.info('imt: %s took %.3f secs' % (imt, (toc_imt - tic_imt)))
+                    # branch values are summed and aggregated in blocks of BRANCH_STATS_BLOCK columns so only a
+                    # (branches x BRANCH_STATS_BLOCK) table is held in memory however long the curve is
+                    hazard = calculate_hazard(rlz_index, values, loc, imt, aggs, weights)
+
+                if task_args.skip_save:
+                    continue
+
+                if not skip_save:
+                    # hazard is rebuilt for every location so it can be converted to probability in place
+                    rate_to_prob(hazard, INV_TIME, out=hazard)
+                    if deagg_dimensions:
+                        # save_deaggs(
+                        #     hazard, bins, loc, imt, imtl, poe, vs30, task_args.hazard_model_id, deagg_dimensions
+                        # )  # TODO: need more information about deagg to save (e.g. poe, inv_time)
+                        save_disaggregation(
+                            aggs[0],
+                            task_args.hazard_model_id,
+                            location,
+                            imt,
+                            vs30,
+                            poe,
+                            imtl,
+                            hazard,
+                            bins,
+                            deagg_dimensions[1],
+                        )
+                    else:
+                        save_aggregation(
+                            aggs,
+                            levels,
+                            hazard,
+                            imt,
+                            vs30,
+                            site_vs30,
+                            task_args.hazard_model_id,
+                            location,
+                            batch,
+                        )
+
+            toc_imt = time.perf_counter()
+            log.info('imt: %s took %.3f secs' % (imt, (toc_imt - tic_imt)))
+
+        # raise any error from the background writes
+        for rlz_write in rlz_writes:
+            rlz_write.result()
 
     toc_fn = time.perf_counter()
     log.info('process_location_list took %.3f secs' % (toc_fn - tic_fn))
@@ -255,6 +337,7 @@ def save_aggregation(
     site_vs30: float,
     hazard_model_id: str,
     location: str,
+    batch: Optional[BatchWrite] = None,
 ) -> None:
     """Save aggregated curves to THS.
 
@@ -276,30 +359,52 @@ def save_aggregation(
         THS ID
     location
         location code
+    batch
+        HazardAggregation batch write to save to. A batch write is opened for just these curves if not provided.
     """
 
-    with model.HazardAggregation.batch_write() as batch:
-        for aggind, agg in enumerate(aggs):
-            hazard_vals = []
-            for j, level in enumerate(levels):
-                hazard_vals.append((level, hazard[j, aggind]))  # tuple lvl, val
+    levels = list(levels)
+    if not levels:
+        log.debug('no hazard_vals for imt %s' % imt)
+        return
 
-            if not hazard_vals:
-                log.debug('no hazard_vals for agg %s imt %s' % (agg, imt))
-                continue
-            else:
-                log.debug('hazard_vals :%s' % hazard_vals)
+    if batch is None:
+        with model.HazardAggregation.batch_write() as batch:
+            save_aggregation(aggs, levels, hazard, imt, vs30, site_vs30, hazard_model_id, location, batch)
+        return
 
-            hag = model.HazardAggregation(
-                values=[model.LevelValuePairAttribute(lvl=lvl, val=val) for lvl, val in hazard_vals],
-                vs30=vs30,
-                imt=imt,
-                agg=agg,
-                hazard_model_id=hazard_model_id,
-            ).set_location(location)
-            if site_vs30:
-                hag.site_vs30 = site_vs30
-            batch.save(hag)
+    # one column per agg, converted to python floats in a single call rather than element by element
+    for agg, agg_vals in zip(aggs, hazard.T.tolist()):
+        hag = model.HazardAggregation(
+            values=[model.LevelValuePairAttribute(lvl=lvl, val=val) for lvl, val in zip(levels, agg_vals)],
+            vs30=vs30,
+            imt=imt,
+            agg=agg,
+            hazard_model_id=hazard_model_id,
+        ).set_location(location)
+        if site_vs30:
+            hag.site_vs30 = site_vs30
+        batch.save(hag)
+
+
+def batch_tasks(tasks: List[AggTaskArgs], num_workers: int) -> List[List[AggTaskArgs]]:
+    """Split tasks into batches to put on the task queue. Batches have at most TASK_BATCH tasks but are made smaller
+    when there are too few tasks to give every worker a batch.
+
+    Parameters
+    ----------
+    tasks
+        the tasks
+    num_workers
+        number of workers taking batches from the queue
+
+    Returns
+    -------
+    batches
+        the tasks, in order, in batches
+    """
+    size = max(min(TASK_BATCH, math.ceil(len(tasks) / num_workers)), 1)
+    return [tasks[i : i + size] for i in range(0, len(tasks), size)]
 
 
 def process_aggregation_local_serial(
@@ -317,15 +422,16 @@ def process_aggregation_local_serial(
 ) -> None:
     """Run task serially. This is only needed if running the debugger"""
 
-    # toshi_ids = {int(k): v for k, v in toshi_ids.items()}
-    # source_branches = {int(k): v for k, v in source_branches.items()}
-
+    # the branch tables are the same for every location so build them once for each vs30
+    branch_tables = {vs30: get_branch_table(logic_trees[vs30]) for vs30 in vs30s}
     for coded_loc in coded_locations:
+        grid_loc = coded_loc.downsample(0.1).code
+        loc = coded_loc.downsample(0.001).code
         for vs30 in vs30s:
             t = AggTaskArgs(
                 hazard_model_id=hazard_model_id,
-                grid_loc=coded_loc.downsample(0.1).code,
-                locs=[coded_loc.downsample(0.001).code],
+                grid_loc=grid_loc,
+                locs=[loc],
                 logic_tree=logic_trees[vs30],
                 aggs=aggs,
                 imts=imts,
@@ -337,6 +443,9 @@ def process_aggregation_local_serial(
                 save_rlz=save_rlz,
                 stride=stride,
                 skip_save=skip_save,
+                weights=branch_tables[vs30].weights,
+                rlz_index=branch_tables[vs30].rlz_index,
+                rlzs=branch_tables[vs30].rlzs,
             )
 
             # process_location_list(t, config.deagg_poes[0])
@@ -387,7 +496,7 @@ def process_aggregation_local(
     result_queue: multiprocessing.Queue = multiprocessing.Queue()
 
     print('Creating %d workers' % num_workers)
-    workers = [AggregationWorkerMP(task_queue, result_queue) for i in range(num_workers)]
+    workers = [AggregationWorkerMP(task_queue, result_queue, logic_trees) for i in range(num_workers)]
     for w in workers:
         w.start()
 
@@ -395,13 +504,16 @@ def process_aggregation_local(
     # Enqueue jobs
     num_jobs = 0
 
+    tasks = []
     for coded_loc in coded_locations:
+        grid_loc = coded_loc.downsample(0.1).code
+        loc = coded_loc.downsample(0.001).code
         for vs30 in vs30s:
             t = AggTaskArgs(
                 hazard_model_id=hazard_model_id,
-                grid_loc=coded_loc.downsample(0.1).code,
-                locs=[coded_loc.downsample(0.001).code],
-                logic_tree=logic_trees[vs30],
+                grid_loc=grid_loc,
+                locs=[loc],
+                logic_tree=None,  # the workers already hold the logic trees
                 aggs=aggs,
                 imts=imts,
                 levels=levels,
@@ -413,12 +525,15 @@ def process_aggregation_local(
                 stride=stride,
                 skip_save=skip_save,
             )
+            tasks.append(t)
 
-            task_queue.put(t)
-            sleep_time = 5
-            log.info('sleeping %s seconds before queuing next task' % sleep_time)
-            time.sleep(sleep_time)
-            num_jobs += 1
+    # tasks are put on the queue in batches to cut the number of puts and pickles through the queue
+    for batch in batch_tasks(tasks, num_workers):
+        task_queue.put(batch)
+        sleep_time = 5
+        log.info('sleeping %s seconds before queuing next task' % sleep_time)
+        time.sleep(sleep_time)
+        num_jobs += len(batch)
 
     # Add a poison pill for each to signal we've done everything
     for i in range(num_workers):
@@ -447,15 +562,14 @@ def process_aggregation(config: AggregationConfig) -> None:
         the config
     """
 
-    logic_trees = {}
-    for vs30 in config.vs30s:
-        logic_trees[vs30] = get_logic_tree(
-            config.lt_config,
-            config.hazard_gts,
-            vs30,
-            gmm_correlations=[],  # TODO: for now no gmm correlations, need a good method for specifying in the config
-            truncate=config.source_branches_truncate,
-        )
+    logic_trees = get_logic_trees(
+        config.lt_config,
+        config.hazard_gts,
+        config.vs30s,
+        gmm_correlations=[],  # TODO: for now no gmm correlations, need a good method for specifying in the config
+        truncate=config.source_branches_truncate,
+        num_workers=NUM_WORKERS,
+    )
     log.info('finished building logic trees')
 
     locations = get_locations(config)
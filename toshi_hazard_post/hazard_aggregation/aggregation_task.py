@@ -67,7 +67,7 @@ def process_args(args: DistributedAggregationTaskArguments) -> None:
     resolution = 0.001
     logic_trees = fetch_logic_trees(args.logic_trees_id)
 
-    print([loc for loc in args.locations])
+    log.debug(args.locations)
     locations = [CodedLocation(loc['lat'], loc['lon'], resolution) for loc in args.locations]
     results = process_aggregation_local(
         hazard_model_id=args.hazard_model_id,
@@ -12,7 +12,7 @@ import toshi_hazard_post.hazard_aggregation.aggregation_task
 from toshi_hazard_post.data_functions import get_levels
 from toshi_hazard_post.local_config import API_URL, NUM_WORKERS, S3_URL, SNS_AGG_TASK_TOPIC, WORK_PATH
 from toshi_hazard_post.locations import get_locations, locations_by_chunk
-from toshi_hazard_post.logic_tree.branch_combinator import get_logic_tree
+from toshi_hazard_post.logic_tree.branch_combinator import get_logic_trees
 from toshi_hazard_post.logic_tree.logic_tree import HazardLogicTree
 from toshi_hazard_post.util import BatchEnvironmentSetting, get_ecs_job_config
 from toshi_hazard_post.util.sns import publish_message
@@ -106,11 +106,13 @@ def distribute_aggregation(config: AggregationConfig, process_mode: str) -> None
     else:
         log.info("building the logic trees.")
 
-        logic_trees = {}
-        for vs30 in config.vs30s:
-            logic_trees[vs30] = get_logic_tree(
-                config.lt_config, config.hazard_gts, vs30, gmm_correlations=[], truncate=config.source_branches_truncate
-            )
+        logic_trees = get_logic_trees(
+            config.lt_config,
+            config.hazard_gts,
+            config.vs30s,
+            gmm_correlations=[],
+            truncate=config.source_branches_truncate,
+        )
         logic_tree_id = save_logic_trees(logic_trees)
         log.info("saved logic trees to id : %s" % logic_tree_id)
 
@@ -17,7 +17,7 @@ from toshi_hazard_post.hazard_aggregation.aggregation import AggTaskArgs, proces
 from toshi_hazard_post.local_config import NUM_WORKERS
 from toshi_hazard_post.locations import get_locations
 from toshi_hazard_post.logic_tree.branch_combinator import get_logic_tree
-from toshi_hazard_post.toshi_api_support import get_deagg_config, get_imtl, toshi_api
+from toshi_hazard_post.toshi_api_support import get_deagg_config, get_gt_args, get_imtl, toshi_api
 
 from .aggregation_config import AggregationConfig
 
@@ -167,6 +167,20 @@ def requested_configs(
         )
 
 
+def _extract_deagg_config(deagg_entry: Dict[str, Any]) -> DeaggConfig:
+    deagg_task_config = json.loads(deagg_entry['arguments']['disagg_config'].replace("'", '"').replace('None', 'null'))
+
+    return DeaggConfig(
+        hazard_model_id=deagg_entry['arguments']['hazard_model_id'],
+        location=deagg_task_config['location'],
+        inv_time=deagg_task_config['inv_time'],
+        agg=deagg_entry['arguments']['hazard_agg_target'],
+        poe=deagg_task_config['poe'],
+        imt=deagg_task_config['imt'],
+        vs30=deagg_task_config['vs30'],
+    )
+
+
 def get_deagg_gtids(
     hazard_gts: List[str],
     lt_config: Path,
@@ -179,31 +193,22 @@ def get_deagg_gtids(
     inv_time: int,
     iter_method: str = '',
 ) -> List[str]:
-    def extract_deagg_config(deagg_entry):
-        deagg_task_config = json.loads(
-            deagg_entry['arguments']['disagg_config'].replace("'", '"').replace('None', 'null')
-        )
-
-        return DeaggConfig(
-            hazard_model_id=deagg_entry['arguments']['hazard_model_id'],
-            location=deagg_task_config['location'],
-            inv_time=deagg_task_config['inv_time'],
-            agg=deagg_entry['arguments']['hazard_agg_target'],
-            poe=deagg_task_config['poe'],
-            imt=deagg_task_config['imt'],
-            vs30=deagg_task_config['vs30'],
-        )
-
-    def num_success(gt):
-        return gt['num_success']
-
     if hazard_gts:
         return hazard_gts
     else:
         gtids = []
         index = get_index_from_s3()
         slt = from_config(lt_config)
-        nbranches = sum([len(fslt.branches) for fslt in slt.fault_system_lts])
+        nbranches = sum(len(fslt.branches) for fslt in slt.fault_system_lts)
+
+        # parse the config of every complete disagg task in the index once rather than for every requested deagg
+        index_configs = [
+            (gt_id, _extract_deagg_config(entry))
+            for gt_id, entry in index.items()
+            if entry['subtask_type'] == 'OpenquakeHazardTask'
+            and entry['hazard_subtask_type'] == 'DISAGG'
+            and entry['num_success'] == nbranches
+        ]
         for deagg in requested_configs(
             locations,
             deagg_agg_targets,
@@ -214,11 +219,7 @@ def get_deagg_gtids(
             inv_time,
             iter_method,
         ):
-            gtids_tmp = []
-            for gt_id, entry in index.items():
-                if entry['subtask_type'] == 'OpenquakeHazardTask' and entry['hazard_subtask_type'] == 'DISAGG':
-                    if deagg == extract_deagg_config(entry) and num_success(entry) == nbranches:
-                        gtids_tmp.append(gt_id)
+            gtids_tmp = [gt_id for gt_id, index_config in index_configs if index_config == deagg]
             if not gtids_tmp:
                 raise Exception("no general task found for deagg {}".format(deagg))
             if len(gtids_tmp) > 1:
@@ -383,8 +384,9 @@ def process_single_deagg(
     log.info('start get_disagg_gt()')
     gtdata = toshi_api.get_disagg_gt(gtid)
     log.info('finish get_disagg_gt()')
-    imtl = get_imtl(gtdata)
-    deagg_config = get_deagg_config(gtdata)
+    gt_args = get_gt_args(gtdata)
+    imtl = get_imtl(gt_args)
+    deagg_config = get_deagg_config(gt_args)
 
     location = deagg_config.location.split('~')
     loc = (float(location[0]), float(location[1]))
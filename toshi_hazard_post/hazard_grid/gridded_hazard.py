@@ -4,27 +4,31 @@ import itertools
 import logging
 import multiprocessing
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Any, Dict, Generator, Iterable, List, Optional, Union
+from typing import Any, Dict, Generator, Iterable, List, Optional, Set, Tuple
 
 import numpy as np
+import numpy.typing as npt
 from nzshm_common.grids import RegionGrid
 from nzshm_common.location import CodedLocation
-from pynamodb.exceptions import QueryError
+from pynamodb.exceptions import PutError, QueryError
 from toshi_hazard_store import model, query_v3
-from toshi_hazard_store.query.gridded_hazard_query import get_gridded_hazard
 
-from .gridded_poe import compute_hazard_at_poe
+from .gridded_poe import compute_hazard_at_poe_batch
 
 log = logging.getLogger(__name__)
 
 INVESTIGATION_TIME = 50
 SPOOF_SAVE = False
 COV_AGG_KEY = 'cov'
+QUERY_CHUNK_SIZE = 200
+QUERY_THREADS = 8
 
-GridHazTaskArgs = namedtuple(
-    "GridHazTaskArgs", "location_keys poe_levels location_grid_id hazard_model_id vs30 imt agg"
-)
+GridHazTaskArgs = namedtuple("GridHazTaskArgs", "poe_levels location_grid_id hazard_model_id vs30 imt agg")
+
+# the grid's location keys, set once per worker process by set_location_keys rather than pickled with every task
+_location_keys: List[str] = []
 
 
 @dataclass
@@ -39,47 +43,73 @@ class DistributedGridTaskArguments:
     force: bool
 
 
+def query_hazard_curves(
+    location_keys: List[str], vs30: int, hazard_model_id: str, imt: str, agg: str
+) -> List[model.HazardAggregation]:
+    """Get the hazard curves of every location, querying chunks of locations concurrently.
+
+    THS makes one DynamoDB query per location, so a whole grid queried serially is dominated by round trips.
+    """
+
+    def query_chunk(locs):
+        return list(query_v3.get_hazard_curves(locs, [vs30], [hazard_model_id], imts=[imt], aggs=[agg]))
+
+    chunks = [location_keys[i : i + QUERY_CHUNK_SIZE] for i in range(0, len(location_keys), QUERY_CHUNK_SIZE)]
+    with ThreadPoolExecutor(max_workers=QUERY_THREADS) as executor:
+        return list(itertools.chain.from_iterable(executor.map(query_chunk, chunks)))
+
+
 def process_gridded_hazard(
     location_keys: List[str],
     poe_levels: Iterable[float],
     location_grid_id: str,
     hazard_model_id: str,
     vs30: int,
-    imt: float,
+    imt: str,
     agg: str,
 ) -> Generator[model.GriddedHazard, None, None]:
-    grid_accel_levels: Dict[float, List] = {poe: [None for i in range(len(location_keys))] for poe in poe_levels}
-    for haz in query_v3.get_hazard_curves(location_keys, [vs30], [hazard_model_id], imts=[imt], aggs=[agg]):
-        accel_levels = [float(val.lvl) for val in haz.values]
-        poe_values = [float(val.val) for val in haz.values]
-        index = location_keys.index(haz.nloc_001)
-        for poe_lvl in poe_levels:
-            try:
-                grid_accel_levels[poe_lvl][index] = compute_hazard_at_poe(
-                    poe_lvl, accel_levels, poe_values, INVESTIGATION_TIME
-                )
-            except ValueError as err:
-                log.warning(
-                    'Error in compute_hazard_at_poe: %s, poe_lvl %s, haz_mod %s, vs30 %s, imt %s, agg %s'
-                    % (err, poe_lvl, hazard_model_id, vs30, imt, agg)
-                )
-                continue
-            log.debug('replaced %s with %s' % (index, grid_accel_levels[poe_lvl][index]))
+    # fill (location, level) tables of the curves once so that each poe level is inverted for all locations at once
+    index_map = {loc: i for i, loc in enumerate(location_keys)}
+    indices, level_table, poe_table = _curve_table(
+        query_hazard_curves(location_keys, vs30, hazard_model_id, imt, agg), index_map
+    )
+    # curves (other than all zero curves) with no poes in the range kept by compute_hazard_at_poe can't be inverted
+    out_of_range = ~np.any((poe_table >= 1e-10) & (poe_table <= 0.632), axis=1) & np.any(poe_table != 0, axis=1)
+
+    grid_accel_levels: Dict[float, npt.NDArray] = {}
+    for poe_lvl in poe_levels:
+        grid_accel_levels[poe_lvl] = np.full(len(location_keys), np.nan)
+        if not indices:
+            continue
+        accels = compute_hazard_at_poe_batch(poe_lvl, level_table, poe_table, INVESTIGATION_TIME)
+        grid_accel_levels[poe_lvl][indices] = accels
+        nerr = np.count_nonzero(np.isnan(accels))
+        if nerr:
+            nrange = np.count_nonzero(out_of_range)
+            log.warning(
+                'Error in compute_hazard_at_poe: Poe values not monotonous at %s locations, no poe values in range at '
+                '%s locations, poe_lvl %s, haz_mod %s, vs30 %s, imt %s, agg %s'
+                % (nerr - nrange, nrange, poe_lvl, hazard_model_id, vs30, imt, agg)
+            )
 
     if agg == 'mean':
-        grid_covs: Dict[float, List] = {poe: [None for i in range(len(location_keys))] for poe in poe_levels}
-        for cov in query_v3.get_hazard_curves(location_keys, [vs30], [hazard_model_id], imts=[imt], aggs=[COV_AGG_KEY]):
-            index = location_keys.index(cov.nloc_001)
-            cov_values = [float(val.val) for val in cov.values]
-            for poe_lvl in poe_levels:
-                if grid_accel_levels[poe_lvl][index] == 0.0:
-                    grid_covs[poe_lvl][index] = 0.0
-                else:
-                    grid_covs[poe_lvl][index] = np.exp(
-                        np.interp(np.log(grid_accel_levels[poe_lvl][index]), np.log(accel_levels), np.log(cov_values))
-                    )
+        cov_indices, cov_levels, cov_values = _curve_table(
+            query_hazard_curves(location_keys, vs30, hazard_model_id, imt, COV_AGG_KEY), index_map
+        )
+
+        # the curves are interpolated in log-log space, take the logs once for all poe levels
+        with np.errstate(divide='ignore'):
+            log_levels = np.log(cov_levels)
+            log_covs = np.log(cov_values)
 
         for poe_lvl in poe_levels:
+            grid_covs = np.full(len(location_keys), np.nan)
+            if cov_indices:
+                accels = grid_accel_levels[poe_lvl][cov_indices]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    covs = np.exp(_interp_rows(np.log(accels), log_levels, log_covs))
+                grid_covs[cov_indices] = np.where(accels == 0.0, 0.0, covs)
+
             yield model.GriddedHazard.new_model(
                 hazard_model_id=hazard_model_id,
                 location_grid_id=location_grid_id,
@@ -87,7 +117,7 @@ def process_gridded_hazard(
                 imt=imt,
                 agg=COV_AGG_KEY,
                 poe=poe_lvl,
-                grid_poes=grid_covs[poe_lvl],
+                grid_poes=_grid_values(grid_covs),
             )
 
     for poe_lvl in poe_levels:
@@ -98,79 +128,151 @@ def process_gridded_hazard(
             imt=imt,
             agg=agg,
             poe=poe_lvl,
-            grid_poes=grid_accel_levels[poe_lvl],
+            grid_poes=_grid_values(grid_accel_levels[poe_lvl]),
+        )
+
+
+def _curve_table(
+    hazard_curves: Iterable[model.HazardAggregation], index_map: Dict[str, int]
+) -> Tuple[List[int], npt.NDArray, npt.NDArray]:
+    """Fill (curve, level) tables of the levels and values of hazard curves, each curve keeping its own levels.
+
+    Curves shorter than the longest are padded by repeating their last level and value, which changes neither
+    the poe inversion nor the interpolation of the curve.
+
+    Parameters
+    ----------
+    hazard_curves
+        the hazard curves
+    index_map
+        the grid index of each location key
+
+    Returns
+    -------
+    indices
+        the grid index of each curve
+    levels
+        the levels of each curve, shape (ncurves, nlevels)
+    values
+        the values of each curve, shape (ncurves, nlevels)
+    """
+    indices, levels, values = [], [], []
+    for haz in hazard_curves:
+        if not haz.values:
+            continue
+        indices.append(index_map[haz.nloc_001])
+        levels.append([float(val.lvl) for val in haz.values])
+        values.append([float(val.val) for val in haz.values])
+
+    nlevels = max((len(row) for row in levels), default=0)
+    level_table, value_table = np.empty((len(indices), nlevels)), np.empty((len(indices), nlevels))
+    for i, (level_row, value_row) in enumerate(zip(levels, values)):
+        n = len(level_row)
+        level_table[i, :n], value_table[i, :n] = level_row, value_row
+        level_table[i, n:], value_table[i, n:] = level_row[-1], value_row[-1]
+    return indices, level_table, value_table
+
+
+def _interp_rows(x: npt.NDArray, xp: npt.NDArray, fp: npt.NDArray) -> npt.NDArray:
+    """Linearly interpolate each row of fp, with sample points the same row of xp, at the matching element of x,
+    clamping like numpy.interp. Repeated points at the end of a row (see _curve_table) are allowed."""
+    rows = np.arange(len(x))
+    ind = np.clip(np.count_nonzero(xp <= x[:, None], axis=1) - 1, 0, xp.shape[1] - 2)
+    x0, dx = xp[rows, ind], xp[rows, ind + 1] - xp[rows, ind]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.clip(np.where(dx > 0, (x - x0) / dx, 0.0), 0.0, 1.0)
+    return fp[rows, ind] + frac * (fp[rows, ind + 1] - fp[rows, ind])
+
+
+def _grid_values(values: npt.NDArray) -> List[Optional[float]]:
+    """Convert grid values to a list, with None for locations that have no value."""
+    return [None if np.isnan(value) else value for value in values.tolist()]
+
+
+def save_gridded_hazard(gridded_hazards: List[model.GriddedHazard], existing_keys: Set[str]) -> None:
+    """Save gridded hazard rows. Rows that don't exist yet are put in DynamoDB batches of 25, existing rows are updated
+    one at a time so that the model's version check applies to them. If a batch fails its rows are saved one at a
+    time in the same way.
+
+    Parameters
+    ----------
+    gridded_hazards
+        the rows to save
+    existing_keys
+        the sort keys of the rows that already exist
+    """
+    new_rows = [ghaz for ghaz in gridded_hazards if ghaz.sort_key not in existing_keys]
+    update_rows = [ghaz for ghaz in gridded_hazards if ghaz.sort_key in existing_keys]
+    if new_rows:
+        try:
+            with model.GriddedHazard.batch_write() as batch:
+                for ghaz in new_rows:
+                    batch.save(ghaz)
+            for ghaz in new_rows:
+                log.info('save %s' % ghaz)
+        except PutError as err:
+            log.warning('batch save of gridded hazard failed, saving rows individually: %s' % err)
+            update_rows = new_rows + update_rows
+
+    for ghaz in update_rows:
+        try:
+            ghaz_old = next(
+                model.GriddedHazard.query(ghaz.partition_key, model.GriddedHazard.sort_key == ghaz.sort_key)
+            )
+            ghaz_old.grid_poes = ghaz.grid_poes
+            ghaz_old.save()
+        except StopIteration:
+            ghaz.save()
+        log.info('save %s' % ghaz)
+
+
+def set_location_keys(location_keys: List[str]) -> None:
+    """Set the location keys used by process_and_save. This is the initializer of the worker pool."""
+    global _location_keys
+    _location_keys = location_keys
+
+
+def process_and_save(task_args: GridHazTaskArgs) -> None:
+    """Calculate and save the gridded hazard for one task, skipping the task if queries are throttled."""
+    try:
+        existing_keys = query_sort_keys(
+            task_args.hazard_model_id,
+            f"{task_args.hazard_model_id}:{task_args.location_grid_id}:{task_args.vs30}:{task_args.imt}:",
         )
+        save_gridded_hazard(list(process_gridded_hazard(_location_keys, *task_args)), existing_keys)
+    except QueryError as e:
+        log.warn('QueryError, queries likely being throttled, skipping task: %s' % (task_args,))
+        log.warn(e)
+        return
+    log.info('task done: %s %s %s %s' % task_args[2:])
+
+
+def gridded_hazard_sort_key(
+    hazard_model_id: str, location_grid_id: str, vs30: float, imt: str, agg: str, poe: float
+) -> str:
+    """The sort key GriddedHazard.new_model gives a row."""
+    return f"{hazard_model_id}:{location_grid_id}:{vs30}:{imt}:{agg}:{poe}"
+
+
+def query_sort_keys(hazard_model_id: str, sort_key_prefix: str) -> Set[str]:
+    """Get the sort keys of the gridded hazard rows of a hazard model that start with sort_key_prefix. Only the keys
+    are fetched so the (large) grids are not downloaded."""
+    return {
+        ghaz.sort_key
+        for ghaz in model.GriddedHazard.query(
+            hazard_model_id,
+            model.GriddedHazard.sort_key.startswith(sort_key_prefix),
+            attributes_to_get=['sort_key'],
+        )
+    }
 
 
-class GriddedHazardWorkerMP(multiprocessing.Process):
-    """A worker that batches and saves records to DynamoDB."""
-
-    def __init__(self, task_queue):
-        multiprocessing.Process.__init__(self)
-        self.task_queue = task_queue
-
-    def run(self):
-        log.info("worker %s running." % self.name)
-        proc_name = self.name
-
-        while True:
-            nt = self.task_queue.get()
-            if nt is None:
-                # Poison pill means shutdown
-                self.task_queue.task_done()
-                log.info('%s: Exiting' % proc_name)
-                break
-
-            try:
-                for ghaz in process_gridded_hazard(*nt):
-                    try:
-                        ghaz_old = next(
-                            model.GriddedHazard.query(ghaz.partition_key, model.GriddedHazard.sort_key == ghaz.sort_key)
-                        )
-                        ghaz_old.grid_poes = ghaz.grid_poes
-                        ghaz_old.save()
-                    except StopIteration:
-                        ghaz.save()
-                    log.info('save %s' % ghaz)
-            except QueryError as e:
-                log.warn('QueryError, queries likely being throttled, skipping task: %s' % nt)
-                log.warn(e)
-
-            self.task_queue.task_done()
-            log.info('%s task done.' % self.name)
-
-
-class SerialQueue:
-    def __init__(self):
-        self.queue = []
-
-    def put(self, task_args: Optional[GridHazTaskArgs]):
-        self.queue.append(task_args)
-
-    def join(self):
-        for task in self.queue:
-            if task:
-                try:
-                    for ghaz in process_gridded_hazard(*task):
-                        try:
-                            ghaz_old = next(
-                                model.GriddedHazard.query(
-                                    ghaz.partition_key, model.GriddedHazard.sort_key == ghaz.sort_key
-                                )
-                            )
-                            ghaz_old.grid_poes = ghaz.grid_poes
-                            ghaz_old.save()
-                        except StopIteration:
-                            ghaz.save()
-                        log.info('save %s' % ghaz)
-                except QueryError as e:
-                    log.warn('QueryError, queries likely being throttled, skipping task: %s' % task)
-                    log.warn(e)
-
-
-class GriddedHazardWorkerS:
-    def start(self):
-        pass
+def get_existing_sort_keys(hazard_model_ids: Iterable[str], location_grid_id: str) -> Set[str]:
+    """Get the sort keys of the gridded hazard rows already saved for a grid, with one query per hazard model."""
+    sort_keys: Set[str] = set()
+    for hazard_model_id in set(hazard_model_ids):
+        sort_keys |= query_sort_keys(hazard_model_id, f"{hazard_model_id}:{location_grid_id}:")
+    return sort_keys
 
 
 def calc_gridded_hazard(
@@ -210,21 +312,10 @@ def calc_gridded_hazard(
 
     log.debug('location_keys: %s' % location_keys)
 
-    task_queue: Union[multiprocessing.JoinableQueue, SerialQueue]
-    if num_workers > 1:
-        task_queue = multiprocessing.JoinableQueue()
-    else:
-        task_queue = SerialQueue()
-
-    workers: List[Union[GriddedHazardWorkerMP, GriddedHazardWorkerS]]
-    if num_workers > 1:
-        log.info('Creating %d workers' % num_workers)
-        workers = [GriddedHazardWorkerMP(task_queue) for i in range(num_workers)]
-    else:
-        workers = [GriddedHazardWorkerS()]
-    for w in workers:
-        w.start()
+    # fetch the keys of every row already saved for the grid up front rather than probing each task
+    existing_keys = set() if force else get_existing_sort_keys(hazard_model_ids, location_grid_id)
 
+    tasks: List[GridHazTaskArgs] = []
     iterator: Iterable[Any] = []
     if iter_method == 'product':
         iterator = itertools.product(hazard_model_ids, vs30s, imts, aggs)
@@ -233,31 +324,27 @@ def calc_gridded_hazard(
     for (hazard_model_id, vs30, imt, agg) in iterator:
 
         if not force:
-            existing_poes = []
-            for ghaz in get_gridded_hazard([hazard_model_id], [location_grid_id], [vs30], [imt], [agg], poe_levels):
-                if (
-                    (ghaz.hazard_model_id == hazard_model_id)
-                    & (ghaz.vs30 == vs30)
-                    & (ghaz.imt == imt)
-                    & (ghaz.agg == agg)
-                ):
-                    existing_poes.append(ghaz.poe)
-            if set(existing_poes) == set(poe_levels):
+            if all(
+                gridded_hazard_sort_key(hazard_model_id, location_grid_id, vs30, imt, agg, poe) in existing_keys
+                for poe in poe_levels
+            ):
                 log.info(
                     'griddded hazard for %s, %s, %s, %s %s already exists, skipping.'
                     % (hazard_model_id, vs30, imt, agg, poe_levels)
                 )
                 continue
         log.info('putting task for %s, %s, %s, %s %s.' % (hazard_model_id, vs30, imt, agg, poe_levels))
-        t = GridHazTaskArgs(location_keys, poe_levels, location_grid_id, hazard_model_id, vs30, imt, agg)
-        task_queue.put(t)
+        tasks.append(GridHazTaskArgs(poe_levels, location_grid_id, hazard_model_id, vs30, imt, agg))
         count += 1
 
-    # Add a poison pill for each to signal we've done everything
-    for i in range(num_workers):
-        task_queue.put(None)
-
-    # Wait for all of the tasks to finish
-    task_queue.join()
+    if num_workers > 1:
+        log.info('Creating %d workers' % num_workers)
+        with multiprocessing.Pool(num_workers, initializer=set_location_keys, initargs=(location_keys,)) as pool:
+            for _ in pool.imap_unordered(process_and_save, tasks, chunksize=1):
+                pass
+    else:
+        set_location_keys(location_keys)
+        for task in tasks:
+            process_and_save(task)
 
     log.info('calc_gridded_hazard() produced %s gridded_hazard rows ' % count)
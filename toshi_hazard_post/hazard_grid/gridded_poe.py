@@ -5,6 +5,8 @@
 from typing import Iterable  # Any, Iterator, List, Tuple
 
 import numpy as np
+import numpy.typing as npt
+from numba import jit
 
 # import pandas as pd
 
@@ -50,6 +52,83 @@ def compute_hazard_at_poe(
     return np.exp(np.interp(np.log(1 / return_period), xp, yp))  # type: ignore
 
 
+@jit(nopython=True, cache=True)
+def _invert_curves(target: float, ground_accels: npt.NDArray, annual_poes: npt.NDArray) -> npt.NDArray:
+    """Numba kernel for compute_hazard_at_poe_batch, each curve is trimmed, checked and interpolated in one pass."""
+
+    ncurves, nlevels = annual_poes.shape
+    hazard = np.empty(ncurves)
+    log_target = np.log(target)
+    for i in range(ncurves):
+        if np.all(annual_poes[i] == 0):
+            hazard[i] = 0.0
+            continue
+
+        # bracket the target with the last valid level above it and the first valid level at or below it
+        monotonic = True
+        last_poe = np.inf
+        ind_above = -1
+        ind_below = -1
+        for j in range(nlevels):
+            poe = annual_poes[i, j]
+            if poe < 1e-10 or poe > 0.632:
+                continue
+            if poe > last_poe:
+                monotonic = False
+                break
+            last_poe = poe
+            if poe > target:
+                ind_above = j
+            elif ind_below < 0:
+                ind_below = j
+
+        if not monotonic or (ind_above < 0 and ind_below < 0):
+            hazard[i] = np.nan
+            continue
+        if ind_above < 0:
+            ind_above = ind_below
+        if ind_below < 0:
+            ind_below = ind_above
+
+        x0, x1 = np.log(annual_poes[i, ind_above]), np.log(annual_poes[i, ind_below])
+        y0, y1 = np.log(ground_accels[i, ind_above]), np.log(ground_accels[i, ind_below])
+        frac = (log_target - x0) / (x1 - x0) if x1 != x0 else 0.0
+        hazard[i] = np.exp(y0 + frac * (y1 - y0))
+
+    return hazard
+
+
+def compute_hazard_at_poe_batch(
+    poe: float, ground_accels: npt.ArrayLike, annual_poes: npt.ArrayLike, investigation_time: int
+) -> npt.NDArray:
+    """Compute hazard at given poe for many hazard curves at once.
+
+    Equivalent to calling compute_hazard_at_poe on each row of annual_poes, but every curve is trimmed, checked and
+    interpolated (in log-log space, clamped to the ends of the trimmed curve like numpy.interp) in a compiled loop.
+
+    Parameters
+    ----------
+    poe
+        probability of exceedance in investigation_time
+    ground_accels
+        ground acceleration levels, shape (nlevels,) when shared by all curves or (ncurves, nlevels)
+    annual_poes
+        annual probabilities of exceedance, shape (ncurves, nlevels)
+    investigation_time
+        investigation time in years
+
+    Returns
+    -------
+    hazard
+        ground acceleration at poe for each curve. NaN where compute_hazard_at_poe would raise a ValueError, i.e. the
+        trimmed curve is empty or not monotonic.
+    """
+    annual_poes = np.ascontiguousarray(annual_poes, dtype=np.float64)
+    ground_accels = np.broadcast_to(np.asarray(ground_accels, dtype=np.float64), annual_poes.shape)
+    target = -np.log(1 - poe) / investigation_time
+    return _invert_curves(target, ground_accels, annual_poes)
+
+
 # def enumerated_product(*args: List[Any]) -> Iterator[Tuple[Tuple[Any, ...], Any]]:
 #     """Get an enumeration over an arbitrary number of lists.
 
@@ -1,6 +1,10 @@
 import ast
+import itertools
 import logging
 import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import lru_cache
 from pathlib import Path
 from typing import Collection, Dict, List, Optional, Union
 
@@ -9,7 +13,7 @@ import toshi_hazard_store
 from nzshm_model.source_logic_tree.logic_tree import FlattenedSourceLogicTree
 from nzshm_model.source_logic_tree.slt_config import from_config
 
-from .logic_tree import HazardLogicTree
+from .logic_tree import GMCMBranch, HazardBranch, HazardLogicTree
 
 DTOL = 1.0e-6
 
@@ -51,35 +55,142 @@ def preload_meta(ids: Collection[str], vs30: int) -> Dict[str, dict]:
     return metadata
 
 
+@lru_cache(maxsize=None)
+def load_flattened_slt(lt_config_filepath: Path) -> FlattenedSourceLogicTree:
+    """Build the flattened source logic tree from a logic tree config file. The config is a python module that is
+    executed to build the tree so the result is cached for the life of the process; it is the same for every vs30.
+
+    Parameters
+    ----------
+    lt_config_filepath
+        path to logic tree config file
+
+    Returns
+    -------
+    fslt
+        the flattened source logic tree. Shared by all callers, do not modify.
+    """
+    return FlattenedSourceLogicTree.from_source_logic_tree(from_config(lt_config_filepath))
+
+
+# the metadata (keyed by vs30) and correlations used by build_gmcm_branches, set once per worker process by
+# set_gmcm_metadata rather than pickled with every source branch
+_metadata: Dict[int, Dict[str, dict]] = {}
+_correlations: List[List[str]] = []
+
+
+def set_gmcm_metadata(metadata: Dict[int, Dict[str, dict]], correlations: List[List[str]]) -> None:
+    """Set the metadata and correlations used by build_gmcm_branches. This is the initializer of the worker pool."""
+    global _metadata, _correlations
+    _metadata = metadata
+    _correlations = correlations
+
+
+def build_gmcm_branches(branch: HazardBranch, vs30: int) -> List[GMCMBranch]:
+    """Build the gmcm branches of a source branch. Used to build the branches in worker processes, see
+    HazardBranch.set_gmcm_branches.
+    """
+    branch.set_gmcm_branches(_metadata[vs30], _correlations)
+    return branch.gmcm_branches
+
+
 def get_logic_tree(
     lt_config_filepath: Union[str, Path],
     hazard_gts: List[str],
     vs30: int,
     gmm_correlations: List[List[str]],
     truncate: Optional[int] = None,
+    num_workers: int = 1,
 ) -> HazardLogicTree:
 
-    fslt = FlattenedSourceLogicTree.from_source_logic_tree(from_config(lt_config_filepath))
+    return get_logic_trees(lt_config_filepath, hazard_gts, [vs30], gmm_correlations, truncate, num_workers)[vs30]
+
+
+def get_logic_trees(
+    lt_config_filepath: Union[str, Path],
+    hazard_gts: List[str],
+    vs30s: List[int],
+    gmm_correlations: List[List[str]],
+    truncate: Optional[int] = None,
+    num_workers: int = 1,
+) -> Dict[int, HazardLogicTree]:
+    """Build the logic tree for each vs30. The source branches and their hazard ids do not depend on vs30 so they are
+    built once and shared; only the gmcm branches are built for each vs30.
+
+    Parameters
+    ----------
+    lt_config_filepath
+        path to logic tree config file
+    hazard_gts
+        general task ids of the Openquake hazard jobs
+    vs30s
+        site conditions
+    gmm_correlations
+        GMCM logic tree correlations
+    truncate
+        only keep this many source branches (for testing)
+    num_workers
+        number of processes used to build the gmcm branches
+
+    Returns
+    -------
+    logic_trees
+        logic trees keyed by vs30
+    """
+
+    fslt = load_flattened_slt(Path(lt_config_filepath))
     log.info('built FlattenedSourceLogicTree')
-    logic_tree = HazardLogicTree.from_flattened_slt(fslt, hazard_gts)
+    source_tree = HazardLogicTree.from_flattened_slt(fslt, hazard_gts)
     log.info('built HazardLogicTree')
-    log.info(f'hazard ids: {logic_tree.hazard_ids}')
-    tic = time.perf_counter()
-    metadata = preload_meta(logic_tree.hazard_ids, vs30)
-    toc = time.perf_counter()
-    print(f'time to load metadata {toc-tic} seconds')
+    hazard_ids = source_tree.hazard_ids
+    log.info(f'hazard ids: {hazard_ids}')
+
+    metadata = {}
+    for vs30 in vs30s:
+        tic = time.perf_counter()
+        metadata[vs30] = preload_meta(hazard_ids, vs30)
+        toc = time.perf_counter()
+        log.debug(f'time to load metadata {toc-tic} seconds')
     log.info('loaded metadata')
 
-    tic = time.perf_counter()
-    for branch in logic_tree.branches:
-        # log.info('set one gmcm branch')
-        branch.set_gmcm_branches(metadata, gmm_correlations)
-    log.info('set gmcm branches')
-    toc = time.perf_counter()
-    print(f'time to set gmcm branches {toc-tic} seconds')
+    logic_trees = {}
+    with ExitStack() as stack:
+        if num_workers > 1:
+            # each source branch's gmcm branches are independent so build them in parallel, the workers are given the
+            # metadata for every vs30 once when they start
+            executor = stack.enter_context(
+                ProcessPoolExecutor(
+                    max_workers=num_workers, initializer=set_gmcm_metadata, initargs=(metadata, gmm_correlations)
+                )
+            )
+
+        for vs30 in vs30s:
+            logic_tree = HazardLogicTree(
+                source_tree.name,
+                source_tree.gt_ids,
+                [HazardBranch(branch.source_branch, branch.hazard_ids) for branch in source_tree.branches],
+            )
+
+            tic = time.perf_counter()
+            if num_workers > 1:
+                chunksize = max(len(logic_tree.branches) // (4 * num_workers), 1)
+                all_gmcm_branches = executor.map(
+                    build_gmcm_branches, logic_tree.branches, itertools.repeat(vs30), chunksize=chunksize
+                )
+                for branch, gmcm_branches in zip(logic_tree.branches, all_gmcm_branches):
+                    branch.gmcm_branches = gmcm_branches
+            else:
+                for branch in logic_tree.branches:
+                    # log.info('set one gmcm branch')
+                    branch.set_gmcm_branches(metadata[vs30], gmm_correlations)
+            log.info('set gmcm branches')
+            toc = time.perf_counter()
+            log.debug(f'time to set gmcm branches {toc-tic} seconds')
+
+            # for testing
+            if truncate:
+                logic_tree.branches = logic_tree.branches[:truncate]
 
-    # for testing
-    if truncate:
-        logic_tree.branches = logic_tree.branches[:truncate]
+            logic_trees[vs30] = logic_tree
 
-    return logic_tree
+    return logic_trees
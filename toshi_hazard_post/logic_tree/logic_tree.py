@@ -5,11 +5,11 @@ Classes to define hazard logic trees and gather openquake run info from Toshi
 """
 import itertools
 from dataclasses import dataclass, field
-from functools import reduce
+from functools import lru_cache, reduce
 from math import isclose
-from operator import mul
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Set
 
+import numpy as np
 from nzshm_model.source_logic_tree.logic_tree import CompositeBranch, FlattenedSourceLogicTree
 
 from toshi_hazard_post.toshi_api_support import SourceSolutionMap, toshi_api
@@ -17,8 +17,29 @@ from toshi_hazard_post.toshi_api_support import SourceSolutionMap, toshi_api
 DTOL = 1.0e-6
 
 
+@lru_cache(maxsize=None)
+def get_source_solution_map(gt_id: str) -> SourceSolutionMap:
+    """Get the mapping of source nrml ids to hazard solution ids for a general task from the ToshiAPI. The result is
+    cached as the same general tasks are requested when building the logic tree for every vs30.
+
+    Parameters
+    ----------
+    gt_id
+        general task id
+
+    Returns
+    -------
+    source_solution_map
+        do not modify, the object is shared by all callers
+    """
+    return toshi_api.get_hazard_gt(gt_id)
+
+
 @dataclass
 class GMCMBranch:
+    # there is one of these for every row of the full logic tree so avoid a per-instance __dict__
+    __slots__ = ('realizations', 'weight')
+
     # gmms: List[str]
     realizations: List[str]  # [int] or [str]?
     weight: float
@@ -103,12 +124,11 @@ class HazardBranch:
             GMCM logic tree correlations, each inner list element contains two ground motion model strings to correlate.
         """
 
-        if correlations:
-            correlation_master = [corr[0] for corr in correlations]
-            correlation_puppet = [corr[1] for corr in correlations]
-        else:
-            correlation_master = []
-            correlation_puppet = []
+        # the gsims correlated to each master gsim, in the order given
+        correlated_puppets: Dict[str, List[str]] = {}
+        for master, puppet in correlations or []:
+            correlated_puppets.setdefault(master, []).append(puppet)
+        correlation_puppet = {corr[1] for corr in correlations or []}
 
         rlz_sets: Dict[str, Any] = {}
         weight_sets: Dict[str, Any] = {}
@@ -132,15 +152,15 @@ class HazardBranch:
 
         if correlations:
             all_rlz = [(gsim, rlz) for rlz_set in rlz_sets.values() for gsim, rlz in rlz_set.items()]
+            rlzs_by_gsim: Dict[str, List[str]] = {}
+            for gsim, rlz in all_rlz:
+                rlzs_by_gsim.setdefault(gsim, []).extend(rlz)
             correlation_list = []
-            all_rlz_copy = all_rlz.copy()
-            for rlzm in all_rlz:
-                for i, cm in enumerate(correlation_master):
-                    if cm == rlzm[0]:
-                        correlation_list.append(rlzm[1].copy())
-                        for rlzp in all_rlz_copy:
-                            if correlation_puppet[i] == rlzp[0]:
-                                correlation_list[-1] += rlzp[1]
+            for gsim, rlz in all_rlz:
+                for puppet in correlated_puppets.get(gsim, []):
+                    correlation_list.append(rlz + rlzs_by_gsim.get(puppet, []))
+            # a correlation with a repeated realization can never be fully matched
+            correlation_sets = [set(cl) for cl in correlation_list if len(set(cl)) == len(cl)]
 
         rlz_sets_tmp = rlz_sets.copy()
         weight_sets_tmp = weight_sets.copy()
@@ -156,19 +176,21 @@ class HazardBranch:
 
         # TODO: fix rlz from the same ID grouped together
         rlz_iter = itertools.product(*rlz_lists)
-        weight_iter = itertools.product(*weight_lists)
+        # the weight of every combination at once, in the same order as itertools.product
+        all_weights = reduce(np.multiply.outer, [np.array(w, dtype=float) for w in weight_lists], np.array(1.0))
         rlz_combs = []
         weight_combs = []
 
-        for src_group, weight_group in zip(rlz_iter, weight_iter):
+        for src_group, weight in zip(rlz_iter, all_weights.ravel().tolist()):
             if correlations:
                 foo = [s for src in src_group for s in src]
-                if any([len(set(foo).intersection(set(cl))) == len(cl) for cl in correlation_list]):
+                foo_set = set(foo)
+                if any(correlation_set <= foo_set for correlation_set in correlation_sets):
                     rlz_combs.append(foo)
-                    weight_combs.append(reduce(mul, weight_group, 1.0))
+                    weight_combs.append(weight)
             else:
                 rlz_combs.append([s for src in src_group for s in src])
-                weight_combs.append(reduce(mul, weight_group, 1.0))
+                weight_combs.append(weight)
 
         sum_weight = sum(weight_combs)
         # if not ((sum_weight > 1.0 - DTOL) & (sum_weight < 1.0 + DTOL)):
@@ -205,11 +227,22 @@ class HazardLogicTree:
         toshi_ids = [id for branch in self.branches for id in branch.hazard_ids]
         return list(set(toshi_ids))
 
+    @property
+    def hazard_realizations(self) -> Dict[str, List[int]]:
+        """The gsim realization numbers used by the gmcm branches, keyed by hazard id."""
+        rlzs: Dict[str, Set[int]] = {}
+        for branch in self.branches:
+            for gmcm_branch in branch.gmcm_branches:
+                for rlz_key in gmcm_branch.realizations:
+                    hazard_id, rlz = rlz_key.split(':')
+                    rlzs.setdefault(hazard_id, set()).add(int(rlz))
+        return {hazard_id: sorted(rlz_set) for hazard_id, rlz_set in rlzs.items()}
+
     @classmethod
     def from_flattened_slt(cls, flat_slt: FlattenedSourceLogicTree, gt_ids: List[str]):
         source_solution_map = SourceSolutionMap()
         for gt_id in gt_ids:
-            source_solution_map.append(toshi_api.get_hazard_gt(gt_id))
+            source_solution_map.append(get_source_solution_map(gt_id))
 
         def yield_haz_branches(branches):
             for comp_branch in branches:
@@ -24,11 +24,15 @@ def args_to_dict(args: List) -> Dict:
     return {arg['k']: arg['v'] for arg in args}
 
 
-def get_deagg_config(data: Dict[str, Any]) -> DeaggConfig:
+def get_gt_args(gtdata: Dict[str, Any]) -> Dict[str, str]:
+    """The arguments of the (first) task of a general task as a dict. Parse once and pass to get_deagg_config and
+    get_imtl rather than walking the arguments for each."""
+
+    return args_to_dict(gtdata['data']['node1']['children']['edges'][0]['node']['child']['arguments'])
+
+
+def get_deagg_config(args: Dict[str, str]) -> DeaggConfig:
 
-    node = data['data']['node1']['children']['edges'][0]
-    args = node['node']['child']['arguments']
-    args = args_to_dict(args)
     deagg_agg_target = args['agg']
     location = ast.literal_eval(args['location_list'])[0]
     vs30 = int(args['vs30'])
@@ -50,15 +54,10 @@ def get_deagg_config(data: Dict[str, Any]) -> DeaggConfig:
     return DeaggConfig(vs30, imt, location, poe, inv_time, deagg_agg_target)
 
 
-def get_imtl(gtdata: Dict[str, Any]) -> Optional[float]:
-
-    for arg in gtdata['data']['node1']['children']['edges'][0]['node']['child']['arguments']:
-        # if arg['k'] == 'disagg_config':
-        #     return json.loads(arg['v'].replace("'", '"').replace('None', 'null'))['level']
-        if arg['k'] == 'level':
-            return float(arg['v'])
+def get_imtl(args: Dict[str, str]) -> Optional[float]:
 
-    return None
+    level = args.get('level')
+    return float(level) if level is not None else None
 
 
 def create_archive(filename: Union[str, Path], working_path: Union[str, PurePath]) -> str:
@@ -154,7 +153,7 @@ class ToshiApi(ToshiFile):
         }
         '''
 
-        print(qry)
+        log.debug(qry)
         input_variables = dict(general_task_id=general_task_id)
         executed = self.run_query(qry, input_variables)
         return {'data': executed}
@@ -9,6 +9,7 @@ from enum import Enum
 from functools import reduce
 from operator import mul
 from pathlib import Path
+from typing import List
 from zipfile import ZipFile
 
 import numpy as np
@@ -95,12 +96,12 @@ def get_location(header):
     return location
 
 
-def match_index(disaggs, values):
+def bin_index(disaggs, dimensions):
+    """
+    map the combined bin key (one value per dimension) to the row position in the disagg DataFrame
+    """
 
-    ind = pd.Series(data=True, index=range(len(disaggs)))
-    for name, value in values.items():
-        ind = ind & disaggs[name].isin([value])
-    return ind
+    return {key: i for i, key in enumerate(zip(*(disaggs[dim] for dim in dimensions)))}
 
 
 def get_values_from_csv(disagg_data):
@@ -148,16 +149,20 @@ def load_file(disagg_file, deagg_dimensions, csv_archive):
 
     ind_rlz = len(deagg_dimensions)
     ind_rlz_csv = ['rlz' in col for col in header].index(True)
+    bin_dimensions = list(disaggs.columns[:ind_rlz])
+    index = bin_index(disaggs, bin_dimensions)
+    rlz_values = np.zeros((len(disaggs), len(rlz_names)))
     for row in disagg_reader:
         disagg_data = DisaggData(*row)
         values = get_values_from_csv(disagg_data)
         imt = disagg_data.imt
-        ind = match_index(disaggs, values)
-        if not any(ind):
+        ind = index.get(tuple(values.get(dim) for dim in bin_dimensions))
+        if ind is None:
             exc_text = f'no index found for {csv_archive} row: {row}'
             exc_text += f'\nvalues: {values}'
             raise Exception(exc_text)
-        disaggs.iloc[ind, ind_rlz:] = list(map(float, row[ind_rlz_csv:]))
+        rlz_values[ind, :] = list(map(float, row[ind_rlz_csv:]))
+    disaggs.iloc[:, ind_rlz:] = rlz_values
 
     return disaggs, bins, location, imt, rlz_names
 
@@ -195,9 +200,9 @@ def get_disagg(csv_archive, deagg_dimensions):
                 )
                 bins = {k: v for k, v in bins.items() if k in deagg_dimensions}
 
-    disaggs_dict = {}
-    for rlz in rlz_names:
-        disaggs_dict[rlz[3:]] = disaggs[rlz].to_numpy(dtype='float64')
+    # extract all realizations as a single block; each rlz is a row view of the transposed array
+    rlz_values = disaggs[rlz_names].to_numpy(dtype='float64').T
+    disaggs_dict = {rlz[3:]: rlz_values[i] for i, rlz in enumerate(rlz_names)}
 
     return disaggs_dict, bins, location, imt
 
@@ -224,10 +229,12 @@ def save_deaggs(deagg_data, bins, loc, imt, imtl, poe, vs30, model_id, deagg_dim
     log.info(f'saved deagg results to {deagg_filename}')
 
 
-def save_realizations(
-    imt: str, loc: str, vs30: int, branch_probs: npt.NDArray, weights: npt.NDArray, logic_tree: HazardLogicTree
-) -> None:
+RLZ_SAVE_DIR = '/work/chrisdc/NZSHM-WORKING/PROD/branch_rlz/'
+
+
+def save_realizations(imt: str, loc: str, vs30: int, branch_probs: npt.NDArray) -> None:
     """Save realization arrays to disk. Should be replaced with write to THS when THS supports saving full realizations.
+    The weights and logic tree that go with the realizations are saved by save_realization_logic_tree.
 
     Parameters
     ----------
@@ -239,18 +246,35 @@ def save_realizations(
         site condition
     branch_probs
         2D array of probabilities (realizations)
+    """
+
+    branches_filepath = RLZ_SAVE_DIR + f'branches_{imt}-{loc}-{vs30}'
+    np.save(branches_filepath, branch_probs)
+
+
+def save_realization_logic_tree(
+    imts: List[str], loc: str, vs30: int, weights: npt.NDArray, logic_tree: HazardLogicTree
+) -> None:
+    """Save the branch weights and logic tree that describe the realizations saved by save_realizations. The files
+    are named for each imt, as readers of the saved realizations expect, but are the same for every imt so the logic
+    tree is only serialised once.
+
+    Parameters
+    ----------
+    imts
+        intensity measure types
+    loc
+        location code string
+    vs30
+        site condition
     weights
         array of weights
-    source_branches
+    logic_tree
         logic tree definition
     """
 
-    save_dir = '/work/chrisdc/NZSHM-WORKING/PROD/branch_rlz/'
-    branches_filepath = save_dir + f'branches_{imt}-{loc}-{vs30}'
-    weights_filepath = save_dir + f'weights_{imt}-{loc}-{vs30}'
-    logic_tree_filepath = save_dir + f'source_branches_{imt}-{loc}-{vs30}.json'
-    np.save(branches_filepath, branch_probs)
-    np.save(weights_filepath, weights)
-    # TODO: this should not be done every time, the logic_tree is the same
-    with open(logic_tree_filepath, 'w') as jsonfile:
-        json.dump(asdict(logic_tree), jsonfile)
+    logic_tree_json = json.dumps(asdict(logic_tree))
+    for imt in imts:
+        np.save(RLZ_SAVE_DIR + f'weights_{imt}-{loc}-{vs30}', weights)
+        with open(RLZ_SAVE_DIR + f'source_branches_{imt}-{loc}-{vs30}.json', 'w') as jsonfile:
+            jsonfile.write(logic_tree_json)
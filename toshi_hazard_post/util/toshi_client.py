@@ -3,6 +3,8 @@ disaggregation realizations"""
 
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path, PurePath
 
 import requests
@@ -12,6 +14,8 @@ from toshi_hazard_post.local_config import API_KEY, API_URL
 
 log = logging.getLogger(__name__)
 
+DOWNLOAD_THREADS = 8
+
 
 def get_archive_info(hazard_soln_id, archive_type):
     """
@@ -43,32 +47,34 @@ def get_archive_info(hazard_soln_id, archive_type):
     return archive_info
 
 
-def download_csv(hazard_soln_ids, dest_folder, overwrite=False):
+def _download_csv(hazard_soln_id, dest_folder, overwrite):
 
-    downloads = dict()
+    file_info = get_archive_info(hazard_soln_id, 'csv')
+    folder = Path(dest_folder, 'downloads', hazard_soln_id)
+    folder.mkdir(parents=True, exist_ok=True)
+    file_path = PurePath(folder, file_info['file_name'])
 
-    for hazard_soln_id in hazard_soln_ids:
+    download = dict(id=file_info['id'], filepath=str(file_path), info=file_info, hazard_id=hazard_soln_id)
 
-        file_info = get_archive_info(hazard_soln_id, 'csv')
-        folder = Path(dest_folder, 'downloads', hazard_soln_id)
-        folder.mkdir(parents=True, exist_ok=True)
-        file_path = PurePath(folder, file_info['file_name'])
+    if not overwrite and os.path.isfile(file_path):
+        log.info(f"Skip DL for existing file: {file_path}")
+        return download
 
-        downloads[file_info['id']] = dict(
-            id=file_info['id'], filepath=str(file_path), info=file_info, hazard_id=hazard_soln_id
-        )
+    r1 = requests.get(file_info['file_url'])
+    with open(str(file_path), 'wb') as f:
+        f.write(r1.content)
+        log.info(f"downloaded input file: {file_path} {f}")
+        os.path.getsize(file_path) == file_info['file_size']
 
-        if not overwrite and os.path.isfile(file_path):
-            log.info(f"Skip DL for existing file: {file_path}")
-            continue
+    return download
 
-        r1 = requests.get(file_info['file_url'])
-        with open(str(file_path), 'wb') as f:
-            f.write(r1.content)
-            log.info(f"downloaded input file: {file_path} {f}")
-            os.path.getsize(file_path) == file_info['file_size']
 
-    return downloads
+def download_csv(hazard_soln_ids, dest_folder, overwrite=False, max_threads=DOWNLOAD_THREADS):
+
+    # the api query and download for each archive are network bound so run them in threads to overlap the latency
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        downloads = executor.map(partial(_download_csv, dest_folder=dest_folder, overwrite=overwrite), hazard_soln_ids)
+        return {download['id']: download for download in downloads}
 
 
 def download_hdf(self, hazard_soln_ids, dest_folder, overwrite=False):